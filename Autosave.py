@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# This program or module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version. It is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""Автосохранение ипотечной истории в фоновом потоке.
+
+Окно сообщает об изменениях (Autosave.changed): при этом снимаются
+копии расчётов (Calculation.snapshot - без глубокого копирования), а
+записываются они в отдельном потоке раз в interval секунд или сразу
+после changes изменений. Файл - журнал (см. Journal.compact): пишется
+во временный файл, который затем переименовывается, поэтому
+автосохранение никогда не бывает записано наполовину.
+"""
+
+__all__ = ['Autosave', 'default_filename']
+
+import os
+import threading
+
+from Journal import Journal
+
+
+def default_filename():
+    """Файл автосохранения по умолчанию (в домашнем каталоге)."""
+    return os.path.join(os.path.expanduser('~'),
+                        '.mortgage_calc.autosave.clc')
+
+
+class Autosave:
+    """Фоновое автосохранение в файл filename.
+
+    Все операции с файлом идут в своём потоке, методы только передают
+    ему данные и поэтому не ждут записи.
+    """
+
+    def __init__(self, filename=None, interval=60, changes=5):
+        self.filename = filename or default_filename()
+        self.interval = interval
+        self.changes = changes
+        # ошибка последней записи (EnvironmentError) или None
+        self.error = None
+        self._condition = threading.Condition()
+        self._pending = None
+        self._count = 0
+        self._remove = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='autosave',
+                                        daemon=True)
+        self._thread.start()
+
+
+    def changed(self, names, calc):
+        """Сообщает об изменении истории.
+
+        calc - {имя: Calculation}, как в окне калькулятора; копии
+        снимаются сразу, поэтому дальнейшие изменения их не трогают.
+        Кэши у копий свои: поток автосохранения считает по ним
+        (Journal.compact), пока окно продолжает считать по оригиналам.
+        """
+        snapshot = (tuple(names),
+                    {name: calc_.snapshot(share_cache=False) \
+                     for name, calc_ in calc.items()})
+        with self._condition:
+            self._pending = snapshot
+            self._count += 1
+            if self._count >= self.changes:
+                self._condition.notify()
+
+
+    def discard(self):
+        """Удаляет автосохранение: история сохранена или изменения не нужны."""
+        with self._condition:
+            self._pending = None
+            self._count = 0
+            self._remove = True
+            self._condition.notify()
+
+
+    def exists(self):
+        """Есть ли автосохранение, оставшееся от прошлого запуска."""
+        return os.path.exists(self.filename)
+
+
+    def stop(self, timeout=None):
+        """Завершает поток (несохранённый снимок записывается)."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join(timeout)
+
+
+    def _run(self):
+        """Поток автосохранения."""
+        while True:
+            with self._condition:
+                if not (self._stopped or self._remove or \
+                        self._count >= self.changes):
+                    self._condition.wait(self.interval)
+                remove, self._remove = self._remove, False
+                pending, self._pending = self._pending, None
+                self._count = 0
+                stopped = self._stopped
+            try:
+                if remove and os.path.exists(self.filename):
+                    os.remove(self.filename)
+                if pending is not None:
+                    Journal(self.filename).compact(*pending)
+                self.error = None
+            except EnvironmentError as err:
+                self.error = err
+            if stopped:
+                return
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# This program or module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version. It is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""Пакетный расчёт ипотечного портфеля без графического интерфейса.
+
+Кредиты читаются потоком из CSV или JSON Lines, считаются в нескольких
+процессах (Calculation) и так же потоком записываются итоги по каждому
+кредиту и, по желанию, графики платежей (история и прогноз):
+
+    python3 Batch.py loans.csv -o summary.csv --schedule schedule.jsonl
+
+CSV - одна строка на платеж, строки одного кредита идут подряд:
+loan,first_date,loan_sum,percent,period,date,payment,recalc
+(у кредита без платежей date пустая). JSON Lines - один кредит на
+строку: {"loan": ..., "first_date": "2015-01-31", "loan_sum": ...,
+"percent": ..., "period": ..., "payments": [{"date": ...,
+"payment": ..., "recalc": true}, ...]}.
+
+В работе одновременно находится не больше window пакетов кредитов,
+поэтому память не зависит от размера портфеля.
+"""
+
+__all__ = ['Loan', 'SCHEDULE_FIELDS', 'SUMMARY_FIELDS', 'compute',
+           'main', 'read_loans', 'run', 'write_rows']
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import datetime
+import itertools
+import json
+import os
+import sys
+
+from Calculation import Calculation, Storage
+from Calculation import SCHEDULE_FIELDS as _CALCULATION_FIELDS
+from MyDateLib import date_plus_months, months
+
+
+# Кредит: номер, дата оформления, сумма, ставка (%), срок (мес.) и
+# платежи [(дата, платеж, пересчёт), ...]
+Loan = collections.namedtuple(
+    'Loan', 'loan first_date loan_sum percent period payments')
+
+SUMMARY_FIELDS = ('loan', 'payments', 'last_date', 'loan_sum', 'period',
+                  'annuity', 'loan_payment', 'bank_interest', 'overpayment',
+                  'profit_bp', 'payoff_date', 'forecast_interest', 'error')
+
+SCHEDULE_FIELDS = ('loan',) + _CALCULATION_FIELDS
+
+
+def read_loans(stream, format_='csv'):
+    """Читает кредиты из потока (генератор Loan).
+
+    Ошибки во входных данных - ValueError с номером строки.
+    """
+    if format_ == 'csv':
+        rows = enumerate(csv.DictReader(stream), start=2)
+        for loan, group in itertools.groupby(rows,
+                                             key=lambda row: row[1]['loan']):
+            group = list(group)
+            line, first = group[0]
+            payments = []
+            for line, row in group:
+                if row.get('date'):
+                    payments.append(_payment(row, line))
+            yield _loan(first, payments, line)
+    elif format_ == 'jsonl':
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+            except ValueError as err:
+                raise ValueError('строка {0}: {1}'.format(line, err))
+            yield _loan(record, [_payment(payment, line) for payment in \
+                                 record.get('payments', ())], line)
+    else:
+        raise ValueError('неизвестный формат: {0}'.format(format_))
+
+
+def compute(loans, schedule=False):
+    """Считает пакет кредитов: список пар (итоги, строки графика).
+
+    Ошибка в одном кредите не останавливает пакет - она попадает в поле
+    error его итогов:
+
+    >>> import datetime
+    >>> first = datetime.date(2015, 1, 31)
+    >>> feb, mar = datetime.date(2015, 2, 28), datetime.date(2015, 3, 31)
+    >>> loans = [Loan('a', first, 100000, 12, 12,
+    ...               [(feb, 9000, False), (feb, 9000, False)]),
+    ...          Loan('b', first, 100000, 12, 12, [(mar, 9000, False)]),
+    ...          Loan('c', first, 100000, 12, 12,
+    ...               [(mar, 9000, False), (feb, 9000, False)])]
+    >>> for result, rows in compute(loans):
+    ...     print(result['loan'], result['payments'], result['error'])
+    a 2 два платежа за 2015-02-28
+    b 1 платеж 2015-03-31, а должен быть за 2015-02-28
+    c 2 None
+    """
+    return [_compute(loan, schedule) for loan in loans]
+
+
+def run(loans, workers=None, schedule=False, batch=16, window=None):
+    """Считает кредиты в workers процессах, результаты - в порядке входа.
+
+    Кредиты отправляются пакетами по batch штук; в работе не больше
+    window пакетов (по умолчанию - вчетверо больше процессов).
+    """
+    batches = iter(lambda: list(itertools.islice(loans, batch)), [])
+    if workers == 1:
+        for loans_ in batches:
+            yield from compute(loans_, schedule)
+        return
+    workers = workers or os.cpu_count() or 1
+    window = window or 4*workers
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for loans_ in batches:
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(compute, loans_, schedule))
+        while pending:
+            yield from pending.popleft().result()
+
+
+def write_rows(stream, fields, format_='csv'):
+    """Сопрограмма-писатель: принимает словари (send) и пишет строки."""
+    if format_ == 'csv':
+        writer = csv.DictWriter(stream, fields, extrasaction='ignore')
+        writer.writeheader()
+        while True:
+            writer.writerow((yield))
+    elif format_ == 'jsonl':
+        while True:
+            row = yield
+            stream.write(json.dumps({field: row.get(field) \
+                                     for field in fields},
+                                    ensure_ascii=False) + '\n')
+    else:
+        raise ValueError('неизвестный формат: {0}'.format(format_))
+
+
+def main(argv=None):
+    """Точка входа командной строки."""
+    parser = argparse.ArgumentParser(
+        description='Пакетный расчёт ипотечных кредитов (без окна).')
+    parser.add_argument('input', help='кредиты: .csv или .jsonl (- stdin)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='итоги по кредитам: .csv или .jsonl (- stdout)')
+    parser.add_argument('--schedule',
+                        help='графики платежей: .csv или .jsonl')
+    parser.add_argument('-f', '--format', choices=('csv', 'jsonl'),
+                        help='формат stdin/stdout (по умолчанию csv)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='число процессов (по умолчанию - все ядра)')
+    args = parser.parse_args(argv)
+
+    errors = 0
+    with _open(args.input, 'r') as input_, \
+         _open(args.output, 'w') as output:
+        summary = write_rows(output, SUMMARY_FIELDS,
+                             _format(args.output, args))
+        next(summary)
+        schedule_file = None
+        if args.schedule:
+            schedule_file = _open(args.schedule, 'w')
+            schedule = write_rows(schedule_file, SCHEDULE_FIELDS,
+                                  _format(args.schedule, args))
+            next(schedule)
+        try:
+            loans = read_loans(input_, _format(args.input, args))
+            for result, rows in run(loans, args.jobs,
+                                    schedule=bool(args.schedule)):
+                if result['error']:
+                    errors += 1
+                    print('Кредит {0}: {1}'.format(result['loan'],
+                                                    result['error']),
+                          file=sys.stderr)
+                summary.send(result)
+                for row in rows:
+                    schedule.send(row)
+        except ValueError as err:
+            print('Ошибка во входных данных: {0}'.format(err),
+                  file=sys.stderr)
+            return 2
+        finally:
+            if schedule_file is not None:
+                schedule_file.close()
+    return 1 if errors else 0
+
+
+def _compute(loan, schedule):
+    """Итоги (словарь) и строки графика одного кредита."""
+    result = dict.fromkeys(SUMMARY_FIELDS)
+    result.update(loan=loan.loan, payments=len(loan.payments))
+    rows = []
+    try:
+        _check_dates(loan)
+        calc = Calculation(loan.first_date, loan.loan_sum, loan.percent,
+                           loan.period)
+        calc.new_payment({date: Storage((payment,), recalc) \
+                          for date, payment, recalc in loan.payments})
+        forecast = calc.projection()
+    except (AssertionError, ArithmeticError, KeyError, ValueError) as err:
+        result['error'] = str(err) or type(err).__name__
+        return result, rows
+    totals = calc.totals()
+    result.update(
+        last_date=str(calc.date), loan_sum=calc.loan_sum, period=calc.period,
+        annuity=calc.actualy_annuity, loan_payment=totals.loan_payment,
+        bank_interest=totals.bank_interest, overpayment=totals.overpayment,
+        profit_bp=totals.profit_bp,
+        payoff_date=str(forecast.dates[-1]) if len(forecast.dates) else \
+                    str(calc.date),
+        forecast_interest=round(float(sum(forecast.bank_interest)), 2))
+    if schedule:
+        for row in calc.schedule():
+            row.update(loan=loan.loan, date=str(row['date']))
+            rows.append(row)
+    return result, rows
+
+
+def _check_dates(loan):
+    """Платежи кредита идут месяц за месяцем с первого, без повторов.
+
+    Проверка явная (ValueError): assert в Calculation.new_payment
+    снимается при python -O, а повторы дат молча схлопнулись бы в словаре.
+    """
+    dates = sorted(date for date, payment, recalc in loan.payments)
+    for number, date in enumerate(dates, start=1):
+        if number > 1 and date == dates[number - 2]:
+            raise ValueError('два платежа за {0}'.format(date))
+        if months(loan.first_date, date) != number:
+            raise ValueError('платеж {0}, а должен быть за {1}'.format(
+                date, date_plus_months(loan.first_date, number)))
+
+
+def _date(text, line):
+    """Дата ГГГГ-ММ-ДД."""
+    try:
+        return datetime.datetime.strptime(str(text).strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('строка {0}: неверная дата {1!r}'.format(line, text))
+
+
+def _field(record, name, type_, line):
+    """Поле записи CSV/JSON, приведённое к типу type_."""
+    try:
+        value = record[name]
+    except KeyError:
+        raise ValueError('строка {0}: нет поля {1!r}'.format(line, name))
+    try:
+        return type_(value)
+    except (TypeError, ValueError):
+        raise ValueError('строка {0}: неверное значение {1}={2!r}'.format(
+            line, name, value))
+
+
+def _format(path, args):
+    """Формат файла по расширению (или из --format для stdin/stdout)."""
+    if path == '-' or path is None:
+        return args.format or 'csv'
+    return 'jsonl' if os.path.splitext(path)[1].lower() in \
+           ('.jsonl', '.json') else 'csv'
+
+
+def _loan(record, payments, line):
+    """Loan из записи CSV/JSON."""
+    return Loan(_field(record, 'loan', str, line),
+                _date(_field(record, 'first_date', str, line), line),
+                _field(record, 'loan_sum', float, line),
+                _field(record, 'percent', float, line),
+                _field(record, 'period', int, line), payments)
+
+
+def _open(path, mode):
+    """Файл или stdin/stdout (для '-'); стандартные потоки не закрываются."""
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return open(stream.fileno(), mode, newline='', closefd=False,
+                    encoding=stream.encoding)
+    return open(path, mode, newline='', encoding='utf-8')
+
+
+def _payment(record, line):
+    """(дата, платеж, пересчёт) из записи CSV/JSON."""
+    recalc = record.get('recalc', False)
+    if isinstance(recalc, str):
+        recalc = recalc.strip().lower() in ('1', 'true', 'yes', 'да')
+    return (_date(_field(record, 'date', str, line), line),
+            _field(record, 'payment', float, line), bool(recalc))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,10 +10,18 @@
 
 """Расчёт платежей по ипотечному кредиту и хранение ипотечной истории."""
 
-__all__ = ['Calculation', 'Storage']
+__all__ = ['Calculation', 'History', 'SCHEDULE_FIELDS', 'Storage', 'Totals']
 
+import array
+import collections
+import collections.abc
+import csv
 import datetime
 import calendar
+import json
+from Engine import Schedule, State, amortize_joint, amortize_kopecks, \
+                   annuity_kopecks, annuity_payment, day_fractions, \
+                   payment_calendar, project, project_rows, sweep, to_kopecks
 from MyDateLib import date_plus_months, correct_date, months, days_in_year
 
 
@@ -49,15 +57,363 @@ class Storage:
                                                    self.period)]))
 
 
+# Поля строки графика платежей (см. Calculation.schedule): kind -
+# 'history' (внесённый платеж) или 'forecast' (прогноз)
+SCHEDULE_FIELDS = ('kind', 'date', 'payment', 'loan_payment', 'bank_interest',
+                   'annuity', 'loan_sum', 'period', 'the_rest', 'overpayment',
+                   'profit_bp')
+
+# Суммы по платежам: погашено долга, проценты банку, переплаты,
+# экономия и кортеж с суммами каждого плательщика
+Totals = collections.namedtuple(
+    'Totals', 'loan_payment bank_interest overpayment profit_bp payment')
+
+
+class History(collections.abc.MutableMapping):
+    """Ипотечная история - словарь {дата платежа: Storage} по порядку дат.
+
+    Платежи идут подряд, месяц за месяцем, поэтому хранятся блоками
+    по номеру месяца, а внутри блока - по столбцам (массивы array:
+    даты, флаги пересчёта, суммы, периоды и матрица платежей
+    плательщиков). Storage создаётся только при обращении к платежу,
+    а обход одного поля (column) идёт по плоскому массиву.
+    Снимок истории (snapshot) разделяет блоки с оригиналом, а блок
+    копируется только когда его меняют (копирование при записи).
+    Менять можно последний платеж и добавлять следующий, удалять -
+    только хвост истории (truncate).
+
+    Для итогов (totals) хранятся накопленные суммы по платежам: они
+    дописываются по мере добавления платежей и обрезаются вместе с
+    историей, поэтому сумма за любой период - разность двух строк.
+    """
+
+    CHUNK = 64
+
+    # столбцы блока и тип элементов массива; payment - платежи всех
+    # плательщиков подряд (payers значений на каждый платеж)
+    COLUMNS = (('date', 'l'), ('recalc', 'b'), ('loan_sum', 'd'),
+               ('loan_payment', 'd'), ('bank_interest', 'd'),
+               ('annuity', 'd'), ('period', 'l'), ('the_rest', 'd'),
+               ('overpayment', 'd'), ('profit_bp', 'd'), ('payment', 'd'))
+
+    def __init__(self, first_date, items=()):
+        self.first_date = first_date
+        self.payers = None
+        self._chunks = []
+        # блоки, которые не разделены ни с одним снимком
+        self._owned = set()
+        self._len = 0
+        # накопленные суммы (см. _cumulative) верны для первых _summed
+        # платежей; список может быть общим со снимком
+        self._sums = []
+        self._summed = 0
+        self._sums_owned = True
+        for date, storage in items:
+            self[date] = storage
+
+
+    def __getstate__(self):
+        return {'first_date': self.first_date, 'items': list(self.items())}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['first_date'], state['items'])
+
+
+    def __getitem__(self, date):
+        i = self._index(date)
+        if i is None:
+            raise KeyError(date)
+        return self._storage(self._chunks[i // self.CHUNK], i % self.CHUNK)
+
+
+    def __setitem__(self, date, storage):
+        i = months(self.first_date, date) - 1
+        self._summed = min(self._summed, max(i, 0))
+        if self.payers is None:
+            self.payers = len(storage.payment)
+        assert len(storage.payment) == self.payers, \
+               "Количество плательщиков не должно меняться."
+        values = (date.toordinal(), storage.recalc, storage.loan_sum,
+                  storage.loan_payment, storage.bank_interest,
+                  storage.annuity, storage.period, storage.the_rest,
+                  storage.overpayment, storage.profit_bp)
+        if i == self._len:
+            if i % self.CHUNK == 0:
+                self._chunks.append({name: array.array(typecode) \
+                                     for name, typecode in self.COLUMNS})
+                self._owned.add(len(self._chunks) - 1)
+            block = self._chunk(i)
+            for (name, typecode), value in zip(self.COLUMNS, values):
+                block[name].append(value)
+            block['payment'].extend(storage.payment)
+            self._len += 1
+        else:
+            assert self._index(date) is not None, \
+                   "Платежи должны идти подряд, месяц за месяцем."
+            block = self._chunk(i)
+            j = i % self.CHUNK
+            for (name, typecode), value in zip(self.COLUMNS, values):
+                block[name][j] = value
+            block['payment'][j*self.payers:(j + 1)*self.payers] = \
+                array.array('d', storage.payment)
+
+
+    def __delitem__(self, date):
+        if self._index(date) != self._len - 1:
+            raise KeyError(date)
+        self.truncate(date)
+
+
+    def __iter__(self):
+        for block in self._chunks:
+            for ordinal in block['date']:
+                yield datetime.date.fromordinal(ordinal)
+
+
+    def __len__(self):
+        return self._len
+
+
+    def column(self, name, start=0, stop=None):
+        """Значения одного поля платежей start..stop-1 (массив array).
+
+        Для payment - платежи всех плательщиков подряд.
+        """
+        stop = self._len if stop is None else min(stop, self._len)
+        start = max(start, 0)
+        width = self.payers if name == 'payment' else 1
+        result = array.array(dict(self.COLUMNS)[name])
+        for k in range(start // self.CHUNK, -(-stop // self.CHUNK)):
+            first = k * self.CHUNK
+            result.extend(self._chunks[k][name][
+                max(start - first, 0)*width:(stop - first)*width])
+        return result
+
+
+    def extend(self, dates, payments, recalcs, schedule):
+        """Дописывает посчитанные платежи в конец истории по столбцам.
+
+        dates - даты платежей (подряд, со следующего месяца), payments -
+        кортежи платежей плательщиков, recalcs - флаги пересчёта,
+        schedule - посчитанные столбцы (Engine.Schedule). Storage при
+        этом не создаются.
+        """
+        if not dates:
+            return
+        assert months(self.first_date, dates[0]) - 1 == self._len, \
+               "Платежи должны идти подряд, месяц за месяцем."
+        if self.payers is None:
+            self.payers = len(payments[0])
+        columns = schedule._asdict()
+        columns['date'] = [date.toordinal() for date in dates]
+        columns['recalc'] = recalcs
+        columns['payment'] = [value for payment in payments \
+                              for value in payment]
+        assert len(columns['payment']) == len(dates) * self.payers, \
+               "Количество плательщиков не должно меняться."
+        self._summed = min(self._summed, self._len)
+        done = 0
+        while done < len(dates):
+            i = self._len
+            if i % self.CHUNK == 0:
+                self._chunks.append({name: array.array(typecode) \
+                                     for name, typecode in self.COLUMNS})
+                self._owned.add(len(self._chunks) - 1)
+            block = self._chunk(i)
+            count = min(self.CHUNK - i % self.CHUNK, len(dates) - done)
+            for name, typecode in self.COLUMNS:
+                width = self.payers if name == 'payment' else 1
+                block[name].extend(
+                    columns[name][done*width:(done + count)*width])
+            done += count
+            self._len += count
+
+
+    def items(self):
+        """Пары (дата, Storage) по порядку дат."""
+        return _HistoryItems(self)
+
+
+    def values(self):
+        """Платежи (Storage) по порядку дат."""
+        return _HistoryValues(self)
+
+
+    def last(self):
+        """Последний платеж: (дата, Storage)."""
+        i = self._len - 1
+        block = self._chunks[i // self.CHUNK]
+        return (datetime.date.fromordinal(block['date'][i % self.CHUNK]),
+                self._storage(block, i % self.CHUNK))
+
+
+    def snapshot(self):
+        """Копия истории за O(число блоков): блоки общие до изменения."""
+        history = History(self.first_date)
+        history.payers = self.payers
+        history._chunks = list(self._chunks)
+        history._len = self._len
+        history._sums = self._sums
+        history._summed = self._summed
+        history._sums_owned = self._sums_owned = False
+        self._owned.clear()
+        return history
+
+
+    def position(self, date):
+        """Сколько платежей в истории раньше указанной даты."""
+        i = min(max(0, months(self.first_date, date) - 1), self._len)
+        if i < self._len and self._ordinal(i) < date.toordinal():
+            i += 1
+        return i
+
+
+    def totals(self, start=0, stop=None):
+        """Суммы по платежам с номерами start..stop-1 (Totals).
+
+        Считается за O(1) по накопленным суммам; после правки платежа
+        накопленные суммы дописываются заново от правки.
+        """
+        stop = self._len if stop is None else min(stop, self._len)
+        start = max(start, 0)
+        if start >= stop:
+            return Totals(0, 0, 0, 0, (0,) * (self.payers or 0))
+        sums = self._cumulative(stop)
+        row = sums[stop - 1]
+        if start:
+            row = [x - y for x, y in zip(row, sums[start - 1])]
+        row = [round(x, 2) for x in row]
+        return Totals(*row[:4], payment=tuple(row[4:]))
+
+
+    def truncate(self, date):
+        """Удаляет все платежи начиная с указанной даты (включая саму дату)."""
+        i = self.position(date)
+        if i >= self._len:
+            return
+        self._summed = min(self._summed, i)
+        count = -(-i // self.CHUNK)
+        del self._chunks[count:]
+        self._owned.intersection_update(range(count))
+        if i % self.CHUNK:
+            block = self._chunk(i)
+            j = i % self.CHUNK
+            for name, typecode in self.COLUMNS:
+                del block[name][j*(self.payers if name == 'payment' else 1):]
+        self._len = i
+        if not i:
+            self.payers = None
+
+
+    def _chunk(self, i):
+        """Блок с i-м платежом, принадлежащий только этой истории."""
+        k = i // self.CHUNK
+        if k not in self._owned:
+            self._chunks[k] = {name: column[:] \
+                               for name, column in self._chunks[k].items()}
+            self._owned.add(k)
+        return self._chunks[k]
+
+
+    def _cumulative(self, count):
+        """Накопленные суммы по первым count платежам.
+
+        sums[i] - суммы погашенного долга, процентов, переплат, экономии
+        и платежей каждого плательщика по платежам 0..i включительно.
+        """
+        if self._summed < count:
+            if self._sums_owned:
+                del self._sums[self._summed:]
+            else:
+                self._sums = self._sums[:self._summed]
+                self._sums_owned = True
+            sums = self._sums
+            row = sums[-1] if sums else (0,) * (4 + self.payers)
+            columns = [self.column(name, self._summed, count) for name in \
+                       ('loan_payment', 'bank_interest', 'overpayment',
+                        'profit_bp')]
+            payments = self.column('payment', self._summed, count)
+            columns.extend(payments[k::self.payers] \
+                           for k in range(self.payers))
+            for values in zip(*columns):
+                row = tuple(x + y for x, y in zip(row, values))
+                sums.append(row)
+            self._summed = count
+        return self._sums
+
+
+    def _index(self, date):
+        """Номер платежа с датой date в истории (или None)."""
+        i = months(self.first_date, date) - 1
+        if 0 <= i < self._len and self._ordinal(i) == date.toordinal():
+            return i
+        return None
+
+
+    def _items(self):
+        """Обходит пары (дата, Storage) по порядку."""
+        for block in self._chunks:
+            for j, ordinal in enumerate(block['date']):
+                yield datetime.date.fromordinal(ordinal), \
+                      self._storage(block, j)
+
+
+    def _ordinal(self, i):
+        """Дата i-го платежа (порядковый номер дня)."""
+        return self._chunks[i // self.CHUNK]['date'][i % self.CHUNK]
+
+
+    def _storage(self, block, j):
+        """Storage с данными j-го платежа блока."""
+        recalc = bool(block['recalc'][j])
+        storage = Storage(
+            tuple(block['payment'][j*self.payers:(j + 1)*self.payers]),
+            recalc, block['loan_sum'][j], block['loan_payment'][j],
+            block['bank_interest'][j], block['annuity'][j],
+            block['period'][j], block['the_rest'][j],
+            block['overpayment'][j], block['profit_bp'][j])
+        # нули без пересчёта остаются целыми, как их записывает расчёт
+        if recalc:
+            storage.the_rest = 0
+        else:
+            storage.overpayment = storage.profit_bp = 0
+        return storage
+
+
+class _HistoryItems(collections.abc.ItemsView):
+    """Пары истории без поиска каждой даты."""
+
+    def __iter__(self):
+        return self._mapping._items()
+
+
+class _HistoryValues(collections.abc.ValuesView):
+    """Платежи истории без поиска каждой даты."""
+
+    def __iter__(self):
+        for date, storage in self._mapping._items():
+            yield storage
+
+
 class Calculation:
     """Класс делает расчёт платежей, экономии и т.д.
 
     Класс обрабатывает три основных случая: новый платеж, редактирование,
     расчет запланированного периода/платежа.
+
+    Если kopecks истинно, история платежей считается в целых копейках
+    (см. Engine.amortize_kopecks): суммы в истории точные до копейки
+    и не накапливают погрешность float. Прогнозы (projection, sweep,
+    advanced_repayment_*) считаются как обычно.
     """
 
-    def __init__(self, first_date, loan_sum, percent, period):
+    # атрибуты, которые считаются заново и не сохраняются в файл
+    _CACHE = ('_calendar_table', '_growth_table')
+
+    def __init__(self, first_date, loan_sum, percent, period, kopecks=False):
         """Ипотечная история: начальные данные, платежы, переплаты и т.д."""
+        self.kopecks = kopecks
         self.first_date = first_date
         self.date = first_date
         self.loan_sum = loan_sum
@@ -65,25 +421,69 @@ class Calculation:
         self.percent = percent / 100
         self.first_period = period
         self.period = period
-        self.data = {}
+        self.data = History(first_date)
         self.first_annuity = self.annuity_payment()
         self.actualy_annuity = self.first_annuity
+        self._reset_cache()
+
+
+    def __getstate__(self):
+        """Кэши не сохраняются (и не копируются) вместе с историей."""
+        state = self.__dict__.copy()
+        for name in self._CACHE:
+            state.pop(name, None)
+        return state
+
+
+    def __setstate__(self, state):
+        """Восстанавливает историю (в том числе из старых файлов)."""
+        self.__dict__.update(state)
+        self.__dict__.setdefault('kopecks', False)
+        if isinstance(self.data, dict):
+            self.data = History(self.first_date, sorted(self.data.items()))
+        self._reset_cache()
 
 
     def advanced_repayment_date(self, payment):
-        """Ежемесячный платёж -> дата последнего платежа."""
+        """Ежемесячный платёж -> дата последнего платежа.
+
+        Месяц погашения ищется бинарным поиском (см. _payoff_offset);
+        перебор по месяцам остаётся только для случаев, когда оценка
+        погрешности округлений не даёт однозначного ответа. Если долг
+        гасится в последний год срока, дата берётся из прогноза
+        (projection): там пересчитанный аннуитет может оказаться больше
+        платежа, и тогда платится аннуитет.
+        """
 
         assert payment > self.actualy_annuity, \
                "Платеж не может быть меньше аннуитетного."
 
-        date = self.date
+        offset = self._payoff_offset(payment)
+        if offset is not None:
+            if offset + 1 <= self.first_period - 12:
+                return self._calendar(offset + 1)[0][offset + 1]
+            return self._projected_end(payment)
+
+        offset = months(self.first_date, self.date)
         loan_sum = self.loan_sum
+        dates, ratios = self._calendar(self.first_period)
+        while loan_sum > payment and offset < self._calendar_limit:
+            if offset == len(ratios):
+                dates, ratios = self._calendar(offset)
+            interest_on_the_loan = round(loan_sum * self.percent * \
+                                         ratios[offset], 2)
+            loan_sum -= (payment - interest_on_the_loan)
+            offset += 1
+        # за пределами календаря (после 9999 года) - как раньше, по датам
+        date = self._calendar(offset)[0][offset]
         while loan_sum > payment:
             interest_on_the_loan = round(loan_sum * self.percent * \
                                          self._ratio(date), 2)
             loan_sum -= (payment - interest_on_the_loan)
             date = self._next_date(date)
         plan_period = self._next_date(date)
+        if months(self.first_date, plan_period) > self.first_period - 12:
+            return self._projected_end(payment)
         return plan_period
 
 
@@ -100,18 +500,17 @@ class Calculation:
         elif finally_date < date:
             finally_date = date
 
-        date = self.date
-        months_ = months(date, finally_date)
+        start = months(self.first_date, self.date)
+        end = months(self.first_date, finally_date)
+        dates, ratios = self._calendar(end)
 
-        r1 = 1 + self.percent * self._ratio(date)
+        r1 = 1 + self.percent * ratios[start]
         numerator = r1
         x = 1
-        date = self._next_date(date)
-        for ign in range(months_ - 1):
-            r = 1 + self.percent * self._ratio(date)
+        for ratio in ratios[start + 1:end]:
+            r = 1 + self.percent * ratio
             numerator *= r
             x = 1 + r*x
-            date = self._next_date(date)
         denominator = x
         plan_payment = round(self.loan_sum * numerator / denominator, 2)
         return plan_payment
@@ -119,29 +518,202 @@ class Calculation:
 
     def annuity_payment(self):
         """Считает аннуитетный платеж"""
-        i = self.percent/12 # проценты / месяцев_в_году
-        n = self.period
-        annuity = round(self.loan_sum * (i*(1+i)**n)/(((1+i)**n) - 1), 2)
-        return annuity
+        return self._annuity(self.loan_sum, self.period)
 
 
-    def new_payment(self, data):
-        """Считает информацию по каждому платежу."""
-        for date, storage in sorted(data.items()):
-            storage = self._calculation(date, storage)
-            self.data[date] = storage
-        self.date = max(self.data)
+    def checkpoint(self, date):
+        """Состояние расчёта перед платежом date (Engine.State).
+
+        Каждый сохранённый месяц хранит остаток долга, период и остаток
+        на счёте, поэтому состояние восстанавливается так же, как после
+        remove_payment(date) - без пересчёта предыдущих месяцев.
+        """
+        last_date = self._last_date(date)
+        if last_date == self.first_date:
+            return State(self.first_loan_sum, self.first_period,
+                         self.first_annuity, 0)
+        info = self.data[last_date]
+        return State(info.loan_sum, info.period,
+                     self._annuity(info.loan_sum, info.period),
+                     info.the_rest)
+
+
+    def restarts(self):
+        """Даты, с которых расчёт начинался заново после remove_payment.
+
+        Такой платеж (см. _unreplayed) посчитан от аннуитета по
+        предыдущему платежу, а не от того, с которым шёл расчёт подряд,
+        поэтому повторить историю можно, только сделав перед ним
+        remove_payment (см. Journal). Если аннуитет сброшен уже после
+        последнего платежа, в список попадает и дата следующего.
+        """
+        end = len(self.data)
+        result = []
+        offset = self._unreplayed(2, end)
+        while offset is not None:
+            result.append(self._calendar(offset)[0][offset])
+            offset = self._unreplayed(offset + 1, end)
+        if self.data:
+            last = self.data[self.date]
+            annuity = self.annuity_payment() if last.recalc else last.annuity
+            if self.actualy_annuity != annuity:
+                result.append(self._next_date(self.date))
+        return result
+
+
+    def edit_payment(self, data):
+        """Заменяет уже внесённые платежи и пересчитывает историю.
+
+        data - {дата: Storage(payment, recalc)} изменённых платежей.
+        Расчёт начинается с состояния перед самым ранним изменённым
+        платежом (см. checkpoint) и останавливается, как только после
+        последнего изменённого платежа состояние совпадёт со старым:
+        дальше история от правки не зависит. Результат тот же, что
+        у remove_payment + new_payment всех платежей после правки
+        (месяцы, посчитанные после удаления платежей с другим аннуитетом,
+        см. _unreplayed, тоже пересчитываются).
+        Возвращает дату последнего пересчитанного платежа.
+        """
+        changed = sorted(data)
+        assert changed[0] in self.data and changed[-1] in self.data, \
+               "Редактировать можно только внесённые платежи."
+        dates, ratios = self._calendar(months(self.first_date, self.date))
+        start = months(self.first_date, changed[0])
+        last = months(self.first_date, changed[-1])
+        end = months(self.first_date, self.date)
+        state = self.checkpoint(changed[0])
+        # до этого месяца хвост истории проверен на совпадение с пересчётом
+        checked = last
+
+        offset = start
+        count = last - start + 1
+        while offset <= end:
+            items = []
+            for date in dates[offset:min(offset + count, end + 1)]:
+                info = data.get(date) or self.data[date]
+                items.append((date, Storage(info.payment, info.recalc)))
+            schedule, state = self._amortize(offset, state, items)
+            stop = None
+            for i, (date, storage) in enumerate(items):
+                if offset + i < last:
+                    continue
+                old = self.data[date]
+                annuity = schedule.annuity[i + 1] if i + 1 < len(items) \
+                          else state.annuity
+                old_annuity = self.data[dates[offset + i + 1]].annuity \
+                              if offset + i < end else self.actualy_annuity
+                if (schedule.loan_sum[i], schedule.period[i],
+                    schedule.the_rest[i], annuity) == (
+                        old.loan_sum, old.period, old.the_rest, old_annuity):
+                    if checked <= offset + i:
+                        checked = self._unreplayed(offset + i + 2, end)
+                    if checked is None:
+                        stop = i + 1
+                        break
+                    last = checked
+            self._store(items[:stop], schedule)
+            if stop is not None:
+                offset += stop
+                break
+            offset += len(items)
+            count *= 2
+
+        if offset <= end:
+            # хвост истории не изменился
+            info = self.data[self.date]
+            self.loan_sum, self.period = info.loan_sum, info.period
+            self.actualy_annuity = self.annuity_payment() if info.recalc \
+                                   else info.annuity
+        else:
+            self.loan_sum, self.period, self.actualy_annuity, ign = state
+        return dates[offset - 1]
+
+
+    def new_payment(self, data, payers=()):
+        """Считает информацию по каждому платежу.
+
+        Платежи должны идти подряд, начиная со следующего за self.date
+        месяца. Весь пакет считается одним проходом (см. Engine.amortize).
+        payers - расчёты отдельных плательщиков (с той же датой и
+        условиями кредита): i-й из них получает i-й платеж из
+        Storage.payment и считается в том же проходе по датам
+        (Engine.amortize_joint), с тем же результатом, что и его
+        собственный new_payment.
+        """
+        items = sorted(data.items())
+        if not items:
+            return
+        start = months(self.first_date, items[0][0])
+        end = months(self.first_date, items[-1][0])
+        assert start == len(self.data) + 1 and end == start + len(items) - 1, \
+               "Платежи должны идти подряд, месяц за месяцем."
+        for calc in payers:
+            assert (calc.first_date, calc.date, calc.percent,
+                    calc.first_period) == (self.first_date, self.date,
+                                           self.percent, self.first_period), \
+                   "Расчёты плательщиков должны идти вместе с общим."
+        dates = [date for date, storage in items]
+        payments = [[storage.payment for date, storage in items]]
+        payments.extend([(payment[i],) for payment in payments[0]] \
+                        for i in range(len(payers)))
+        recalcs = [storage.recalc for date, storage in items]
+
+        calcs = [self] + list(payers)
+        last_date = self._last_date(items[0][0])
+        results = self._amortize_joint(
+            start, [calc._state(last_date) for calc in calcs],
+            [[sum(payment) for payment in calc_payments] \
+             for calc_payments in payments],
+            recalcs)
+        for calc, calc_payments, (schedule, state) in zip(
+                calcs, payments, results):
+            calc.data.extend(dates, calc_payments, recalcs, schedule)
+            calc.loan_sum, calc.period, calc.actualy_annuity, ign = state
+            calc.date = dates[-1]
+
+
+    def export(self, stream, format_='csv', payment=None):
+        """Пишет график платежей (см. schedule) в поток построчно.
+
+        format_ - 'csv' или 'jsonl'. Возвращает число записанных строк.
+        """
+        rows = self.schedule(payment)
+        if format_ == 'csv':
+            writer = csv.DictWriter(stream, SCHEDULE_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        elif format_ == 'jsonl':
+            write = lambda row: stream.write(
+                json.dumps(row, ensure_ascii=False) + '\n')
+        else:
+            raise ValueError('неизвестный формат: {0}'.format(format_))
+        count = 0
+        for row in rows:
+            row['date'] = str(row['date'])
+            write(row)
+            count += 1
+        return count
+
+
+    def projection(self, payment=None):
+        """Прогноз оставшихся платежей до конца кредита (Engine.Schedule).
+
+        Без payment - по текущему аннуитетному платежу, иначе -
+        ежемесячным платежом payment с пересчётом.
+        """
+        return project(self.first_date, self.percent, self.first_period,
+                       months(self.first_date, self.date) + 1,
+                       State(self.loan_sum, self.period,
+                             self.actualy_annuity, 0),
+                       payment)
 
 
     def remove_payment(self, date):
         """Удаляет все платежи начиная с указанной даты (включая саму дату)."""
-        for key in sorted(self.data, reverse=True):
-            if key < date:
-                break
-            del self.data[key]
+        self.data.truncate(date)
 
         if self.data:
-            max_date = max(self.data)
+            max_date = self.data.last()[0]
             self.loan_sum = self.data[max_date].loan_sum
             self.period = self.data[max_date].period
             self.actualy_annuity = self.annuity_payment()
@@ -153,66 +725,293 @@ class Calculation:
             self.date = self.first_date
 
 
-    def _calculation(self, date, storage):
-        """Метод считает ежемесячные изменения."""
-        storage.annuity = self.actualy_annuity
-        last_date = self._last_date(date)
-        storage.bank_interest = self._interest_on_the_loan(last_date)
-        storage.loan_payment = round(storage.annuity - storage.bank_interest, 2)
-        self.loan_sum = storage.loan_sum = round(
-            self.loan_sum - storage.loan_payment, 2)
-        if storage.recalc:
-            storage.overpayment = round(
-                sum(storage.payment) - storage.annuity + \
-                (self.data[last_date].the_rest if last_date != self.first_date \
-                 else 0)*1.005, 2)
-            self.loan_sum = storage.loan_sum = self.loan_sum - \
-                            storage.overpayment
-            self.period = storage.period = self.first_period - \
-                          months(self.first_date, date)
-            storage.profit_bp = self._profit_bp(date, storage.overpayment)
-            self.actualy_annuity = self.annuity_payment()
-            storage.the_rest = 0
-        else:
-            storage.period = self.period
-            storage.the_rest = round(
-                sum(storage.payment) - storage.annuity + \
-                (self.data[last_date].the_rest if last_date != self.first_date \
-                 else 0)*1.005, 2)
-            storage.overpayment = 0
-            storage.profit_bp = 0
-        self.date = date
-        return storage
+    def schedule(self, payment=None):
+        """График платежей: история и прогноз до конца кредита.
+
+        Генератор словарей с полями SCHEDULE_FIELDS; прогноз - как у
+        projection(payment), но месяцы считаются по мере обхода
+        (Engine.project_rows), и весь график в памяти не хранится.
+        """
+        for date, info in self.data.items():
+            yield {'kind': 'history', 'date': date,
+                   'payment': sum(info.payment),
+                   'loan_payment': info.loan_payment,
+                   'bank_interest': info.bank_interest,
+                   'annuity': info.annuity, 'loan_sum': info.loan_sum,
+                   'period': info.period, 'the_rest': info.the_rest,
+                   'overpayment': info.overpayment,
+                   'profit_bp': info.profit_bp}
+        for row in project_rows(self.first_date, self.percent,
+                                self.first_period,
+                                months(self.first_date, self.date) + 1,
+                                State(self.loan_sum, self.period,
+                                      self.actualy_annuity, 0),
+                                payment):
+            yield dict(zip(SCHEDULE_FIELDS, ('forecast',) + row))
 
 
-    def _interest_on_the_loan(self, date):
-        """Сумма, которую забирает банк (за пользование кредитом).
+    def snapshot(self, date=None, share_cache=True):
+        """Копия расчёта без глубокого копирования истории.
 
-        date - датой последнего платежа
+        История разделяется с оригиналом (см. History.snapshot), кэши
+        календаря общие. Если share_cache ложно, у копии свои кэши
+        (строятся заново) - такую копию можно считать в другом потоке.
+        Если передана дата - копия урезается, как после
+        remove_payment(date).
         """
-        return round(self.loan_sum * self.percent * self._ratio(date), 2)
+        calc = object.__new__(Calculation)
+        calc.__dict__.update(self.__dict__)
+        calc.data = self.data.snapshot()
+        if not share_cache:
+            calc._reset_cache()
+        if date is not None:
+            calc.remove_payment(date)
+        return calc
+
+
+    def totals(self, start=None, end=None):
+        """Итоги по платежам с датами start <= дата < end (Totals).
+
+        Без аргументов - по всей истории: сколько погашено долга,
+        уплачено процентов, переплачено, сэкономлено и внесено каждым
+        плательщиком.
+        """
+        return self.data.totals(
+            0 if start is None else self.data.position(start),
+            None if end is None else self.data.position(end))
+
+
+    def sweep(self, payments=None, dates=None, workers=None):
+        """Варианты досрочного погашения одной таблицей (Engine.Sweep).
+
+        Принимает набор ежемесячных платежей или набор желаемых дат
+        окончания кредита (даты переводятся в платежи, как в
+        advanced_repayment_payment). Для каждого варианта - дата
+        последнего платежа, проценты банку до конца кредита и экономия
+        на процентах относительно банковского графика. workers - число
+        процессов для расчёта (см. Engine.sweep).
+        """
+        assert (payments is None) != (dates is None), \
+               "Нужны либо платежи, либо даты."
+        if dates is not None:
+            payments = [self.advanced_repayment_payment(date) \
+                        for date in dates]
+        return sweep(self.first_date, self.percent, self.first_period,
+                     months(self.first_date, self.date) + 1,
+                     State(self.loan_sum, self.period,
+                           self.actualy_annuity, 0),
+                     payments, workers)
+
+
+    def _amortize(self, start, state, items):
+        """Считает пакет платежей [(дата, Storage), ...] с месяца start."""
+        [result] = self._amortize_joint(
+            start, [state], [[sum(storage.payment) for date, storage in items]],
+            [storage.recalc for date, storage in items])
+        return result
+
+
+    def _amortize_joint(self, start, states, totals, recalcs):
+        """Считает платежи нескольких расчётов с месяца start.
+
+        См. Engine.amortize_joint; в копеечном режиме - через
+        Engine.amortize_kopecks, с переводом сумм в копейки и обратно.
+        """
+        dates, ratios = self._calendar(start + len(recalcs))
+        if not self.kopecks:
+            return amortize_joint(
+                self.percent, self.first_period,
+                ratios[start - 1:start - 1 + len(recalcs)], start, states,
+                totals, recalcs, arrays=False)
+        results = amortize_kopecks(
+            self.percent, self.first_period,
+            day_fractions(dates[start - 1:start + len(recalcs)]), start,
+            [State(to_kopecks(state.loan_sum), state.period,
+                   to_kopecks(state.annuity), to_kopecks(state.the_rest)) \
+             for state in states],
+            [[to_kopecks(total) for total in calc_totals] \
+             for calc_totals in totals],
+            recalcs)
+        return [(Schedule(None, *[column if name == 'period' else \
+                                  [value/100 for value in column] \
+                                  for name, column in \
+                                  zip(Schedule._fields[1:], schedule[1:])]),
+                 State(state.loan_sum/100, state.period, state.annuity/100,
+                       state.the_rest/100)) \
+                for schedule, state in results]
+
+
+    def _annuity(self, loan_sum, period):
+        """Аннуитетный платеж по остатку долга (с учётом режима)."""
+        if self.kopecks:
+            return annuity_kopecks(to_kopecks(loan_sum), self.percent,
+                                   period) / 100
+        return annuity_payment(loan_sum, self.percent, period)
+
+
+    def _state(self, last_date):
+        """Состояние расчёта для продолжения после платежа last_date."""
+        the_rest = self.data[last_date].the_rest \
+                   if last_date != self.first_date else 0
+        return State(self.loan_sum, self.period, self.actualy_annuity,
+                     the_rest)
+
+
+    def _unreplayed(self, start, end):
+        """Первый месяц из start..end, который пересчитался бы иначе.
+
+        После remove_payment аннуитет пересчитывается по последнему
+        платежу, поэтому следующий за удалением месяц может отличаться
+        от того, что дал бы расчёт подряд. None - если таких месяцев нет.
+        """
+        dates, ratios = self._calendar(end)
+        for offset in range(start, end + 1):
+            last = self.data[dates[offset - 1]]
+            annuity = self._annuity(last.loan_sum, last.period) \
+                      if last.recalc else last.annuity
+            if self.data[dates[offset]].annuity != annuity:
+                return offset
+        return None
+
+
+    def _calendar(self, count):
+        """Календарь платежей: даты и коэффициенты дней месяцев 0..count.
+
+        Строится один раз (до конца кредитного периода, см.
+        Engine.payment_calendar) и при необходимости дорастает;
+        дальше даты и коэффициенты берутся по номеру месяца.
+        """
+        dates, ratios = self._calendar_table
+        if len(dates) <= count:
+            assert count <= self._calendar_limit, "Дата за пределами календаря"
+            new_dates, new_ratios = payment_calendar(
+                self.first_date, min(max(count, 2*len(dates),
+                                         self.first_period),
+                                     self._calendar_limit),
+                len(dates))
+            dates.extend(new_dates)
+            ratios.extend(new_ratios)
+        return dates, ratios
+
+
+    @property
+    def _calendar_limit(self):
+        """Последний месяц, который может быть в календаре платежей.
+
+        (следующая за ним дата платежа должна уложиться в datetime.date)
+        """
+        return months(self.first_date, datetime.date.max) - 1
+
+
+    def _growth(self, count):
+        """Таблица роста долга по месяцам 0..count (без учёта платежей).
+
+        growth[t] - произведение (1 + percent*ratio) по месяцам до t,
+        inverse[t] - сумма 1/growth[j] для j = 1..t. Тогда долг через
+        месяцы s..t при платеже P без округлений равен
+        growth[t]*(loan_sum/growth[s] - P*(inverse[t] - inverse[s])).
+        Таблица строится один раз и дорастает по мере надобности.
+        """
+        growth, inverse = self._growth_table
+        if len(growth) <= count:
+            dates, ratios = self._calendar(count)
+            for ratio in ratios[len(growth) - 1:]:
+                growth.append(growth[-1] * (1 + self.percent*ratio))
+                inverse.append(inverse[-1] + 1/growth[-1])
+        return growth, inverse
+
+
+    def _payoff_offset(self, payment):
+        """Номер месяца, в котором долг станет не больше платежа.
+
+        Возвращает None, если месяц нельзя определить однозначно,
+        и тогда нужен прямой перебор по месяцам.
+        """
+        start = months(self.first_date, self.date)
+        loan_sum = self.loan_sum
+        if loan_sum <= payment:
+            return start
+        # долг должен гарантированно уменьшаться каждый месяц
+        # (максимальный коэффициент дней - 31/365)
+        if payment <= loan_sum * self.percent * 31/365 + 0.01:
+            return None
+        limit = start + 12*100
+        growth, inverse = self._growth(start + 1)
+
+        def debt(t):
+            """Долг в месяце t без округлений и оценка погрешности."""
+            paid = inverse[t] - inverse[start]
+            value = growth[t]*(loan_sum/growth[start] - payment*paid)
+            # округление процентов до копеек + погрешность float
+            error = 0.00500001*growth[t]*paid + 1e-9*growth[t]*(
+                loan_sum/growth[start] + payment*paid) + 1e-7
+            return value, error
+
+        # ищем границу удвоением шага, а затем бинарным поиском
+        low, high = start, start + 1
+        while debt(high)[0] > payment:
+            low, high = high, start + 2*(high - start)
+            if high > limit:
+                return None
+            growth, inverse = self._growth(high)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if debt(middle)[0] <= payment:
+                high = middle
+            else:
+                low = middle
+        offset = high
+
+        value, error = debt(offset)
+        if value + error > payment:
+            return None
+        if offset - 1 > start:
+            value, error = debt(offset - 1)
+            if value - error <= payment:
+                return None
+        return offset
+
+
+    def _projected_end(self, payment):
+        """Дата последнего платежа по прогнозу с ежемесячным платежом."""
+        dates = self.projection(payment).dates
+        return dates[-1] if dates else self._next_date(self.date)
 
 
     def _last_date(self, date):
         """Возвращает дату предыдущего платежа платежа"""
-        return date_plus_months(date, -1, initdate=self.first_date)
+        offset = months(self.first_date, date) - 1
+        if not 0 <= offset <= self._calendar_limit:
+            return date_plus_months(date, -1, initdate=self.first_date)
+        return self._calendar(offset)[0][offset]
 
 
     def _next_date(self, date):
         """Возвращает дату следующего платежа"""
-        return date_plus_months(date, 1, initdate=self.first_date)
+        offset = months(self.first_date, date) + 1
+        if not 0 <= offset <= self._calendar_limit:
+            return date_plus_months(date, 1, initdate=self.first_date)
+        return self._calendar(offset)[0][offset]
 
 
-    def _profit_bp(self, date, overpayment):
-        """Экономия от каждой переплаты.
+    def _reset_cache(self):
+        """Сбрасывает кэши расчёта."""
+        self._calendar_table = ([], [])
+        self._growth_table = ([1.0], [0.0])
 
-        Экономия отсчитывается относительно оставшегося банковского
-        периода кредита.
-        """
-        profit = Calculation(
-            first_date=date, loan_sum=overpayment, percent=self.percent*100,
-            period=self.period).actualy_annuity * self.period - overpayment
-        return round(profit, 2)
+
+    def _store(self, items, schedule):
+        """Записывает посчитанные платежи в историю."""
+        for i, (date, storage) in enumerate(items):
+            storage.annuity = schedule.annuity[i]
+            storage.bank_interest = schedule.bank_interest[i]
+            storage.loan_payment = schedule.loan_payment[i]
+            storage.loan_sum = schedule.loan_sum[i]
+            storage.period = schedule.period[i]
+            storage.the_rest = schedule.the_rest[i]
+            storage.overpayment = schedule.overpayment[i]
+            storage.profit_bp = schedule.profit_bp[i]
+            self.data[date] = storage
 
 
     def _ratio(self, date):
@@ -222,6 +1021,11 @@ class Calculation:
         к дней в году, учитывая стык с високосным годом. Дата должна
         быть датой последнего платежа.
         """
+        offset = months(self.first_date, date)
+        if 0 <= offset <= self._calendar_limit:
+            dates, ratios = self._calendar(offset)
+            if dates[offset] == date:
+                return ratios[offset]
 
         next_date = self._next_date(date)
         if next_date.month == 1 and calendar.isleap(next_date.year):
@@ -269,5 +1073,244 @@ def main():
     print(calculation.actualy_annuity)
 
 
+# регрессионные проверки (python3 -m doctest Calculation.py)
+__test__ = {
+    'sweep': """
+Варианты sweep совпадают с прогнозом (projection), с
+advanced_repayment_date и между собой с NumPy и без него; платежи,
+посчитанные под даты, гасят кредит ровно в эти даты (кроме последнего
+года срока: там пересчитанный аннуитет может обогнать платёж).
+
+>>> import random
+>>> import Engine
+>>> def sweep_errors(calc, payments=None, dates=None):
+...     swept = calc.sweep(payments, dates)
+...     numpy, Engine.numpy = Engine.numpy, None
+...     try:
+...         plain = calc.sweep(payments, dates)
+...     finally:
+...         Engine.numpy = numpy
+...     errors = []
+...     for k, payment in enumerate(swept.payment):
+...         schedule = calc.projection(payment)
+...         interest = round(float(sum(schedule.bank_interest)), 2)
+...         if (swept.dates[k], swept.interest[k]) != \\
+...            (plain.dates[k], plain.interest[k]) or \\
+...            (swept.dates[k], swept.interest[k]) != \\
+...            (schedule.dates[-1], interest) or \\
+...            dates is not None and swept.dates[k] != dates[k] or \\
+...            payment > calc.actualy_annuity and \\
+...            swept.dates[k] != calc.advanced_repayment_date(payment):
+...             errors.append(payment)
+...     return errors
+>>> random.seed(1)
+>>> errors = []
+>>> for k in range(40):
+...     calc = Calculation(
+...         datetime.date(random.randint(2000, 2020), random.randint(1, 12),
+...                       random.randint(1, 28)),
+...         random.randint(100, 5000) * 1000, random.uniform(3, 20),
+...         random.choice((60, 120, 240, 360)))
+...     errors += sweep_errors(calc, payments=[
+...         round(calc.actualy_annuity * random.uniform(1.001, 5), 2) \\
+...         for i in range(5)])
+...     errors += sweep_errors(calc, dates=[
+...         calc._calendar(t)[0][t] \\
+...         for t in random.sample(range(2, calc.first_period - 11), 5)])
+>>> errors
+[]
+""",
+    'export': """
+Выгруженный прогноз кончается датой advanced_repayment_date, без
+лишней строки с копейками остатка.
+
+>>> import csv, io
+>>> calc = Calculation(datetime.date(2013, 7, 10), 900000, 14.5, 120)
+>>> calc.new_payment({
+...     datetime.date(2013, 8, 10): Storage((20000,), recalc=True),
+...     datetime.date(2013, 9, 10): Storage((15000,), recalc=False)})
+>>> for target in (datetime.date(2015, 3, 10), datetime.date(2017, 1, 10),
+...                datetime.date(2020, 6, 10)):
+...     payment = calc.advanced_repayment_payment(target)
+...     for format_ in ('csv', 'jsonl'):
+...         stream = io.StringIO()
+...         count = calc.export(stream, format_, payment=payment)
+...         ign = stream.seek(0)
+...         rows = list(csv.DictReader(stream)) if format_ == 'csv' else \\
+...                [json.loads(line) for line in stream]
+...         print(format_, len(rows) == count, rows[-1]['date'],
+...               rows[-1]['date'] == str(calc.advanced_repayment_date(payment)),
+...               float(rows[-1]['payment']) > 1)
+csv True 2015-03-10 True True
+jsonl True 2015-03-10 True True
+csv True 2017-01-10 True True
+jsonl True 2017-01-10 True True
+csv True 2020-06-10 True True
+jsonl True 2020-06-10 True True
+""",
+    'edit': """
+edit_payment даёт то же, что remove_payment + new_payment всех платежей
+после правки: и когда пересчёт останавливается раньше конца истории,
+и в истории, где платежи удаляли и вносили заново (аннуитет после
+remove_payment, см. _unreplayed), и когда правка закрывает кредит и
+платежи после неё удаляются (как в MainWindow.paymentEdit).
+Пересчёт останавливается, как только состояние совпадёт со старым,
+т. е. когда правка ничего не меняет дальше.
+
+>>> import random
+>>> def state(calc):
+...     return ([list(calc.data.column(name)) for name, typecode in
+...              History.COLUMNS],
+...             calc.loan_sum, calc.period, calc.actualy_annuity, calc.date)
+>>> random.seed(3)
+>>> errors = []
+>>> stopped = removed_count = 0
+>>> for k in range(80):
+...     calc = Calculation(
+...         datetime.date(random.randint(2000, 2020), random.randint(1, 12),
+...                       random.randint(1, 28)),
+...         random.randint(100, 5000) * 1000, random.uniform(3, 20),
+...         random.choice((60, 120, 240)), kopecks=k % 4 == 0)
+...     dates = calc._calendar(40)[0][1:41]
+...     payment = lambda low, high: Storage(
+...         (round(calc.first_annuity * random.uniform(low, high), 2),),
+...         random.random() < 0.3)
+...     payments = {date: payment(1, 2) for date in dates}
+...     calc.new_payment({date: payments[date] for date in dates[:25]})
+...     cut = random.randrange(5, 25)
+...     calc.remove_payment(dates[cut])
+...     calc.new_payment({date: payments[date] for date in dates[cut:]})
+...     changes = {dates[i]: payment(0.9, 3)
+...                for i in random.sample(range(40), random.randint(1, 3))}
+...     if random.random() < 0.3:
+...         # те же платежи ещё раз (как галки без изменений в форме)
+...         changes = {date: payments[date] for date in changes}
+...     removed = date_plus_months(max(changes), random.randint(1, 5),
+...                                initdate=calc.first_date) \\
+...               if random.random() < 0.3 else None
+...     if removed is not None and removed > calc.date:
+...         removed = None
+...     expected = calc.snapshot(share_cache=False)
+...     expected.remove_payment(min(changes))
+...     expected.new_payment({
+...         date: changes.get(date) or payments[date]
+...         for date in dates if date >= min(changes) and
+...                              (removed is None or date < removed)})
+...     if removed is not None:
+...         calc.remove_payment(removed)
+...         removed_count += 1
+...     last = calc.edit_payment(changes)
+...     stopped += last < calc.date
+...     if state(calc) != state(expected):
+...         errors.append(k)
+>>> errors, stopped > 5, removed_count > 10
+([], True, True)
+""",
+    'snapshot': """
+Снимок (Calculation.snapshot, History.snapshot) не меняется, когда
+меняют оригинал - удаляют хвост, вносят другие платежи, переписывают
+последний платеж, - и наоборот; на это рассчитано автосохранение
+(Autosave), которое пишет снимок в другом потоке.
+
+>>> def state(calc):
+...     return ([list(calc.data.column(name)) for name, typecode in
+...              History.COLUMNS],
+...             calc.loan_sum, calc.period, calc.actualy_annuity, calc.date,
+...             calc.totals(), calc.totals(datetime.date(2016, 1, 1)))
+>>> first = datetime.date(2013, 7, 3)
+>>> dates = Calculation(first, 900000, 14.5, 120)._calendar(100)[0][1:101]
+>>> calc = Calculation(first, 900000, 14.5, 120)
+>>> calc.new_payment({date: Storage((15000, 5000), i % 7 == 0)
+...                   for i, date in enumerate(dates[:70])})
+>>> copy = calc.snapshot()
+>>> frozen = state(copy)
+>>> calc.remove_payment(dates[60])
+>>> calc.new_payment({date: Storage((20000, 0), True)
+...                   for date in dates[60:100]})
+>>> info = calc.data[dates[99]]
+>>> info.payment = (1, 2)
+>>> calc.data[dates[99]] = info
+>>> ign = calc.totals()
+>>> calc.remove_payment(dates[10])
+>>> ign = calc.totals()
+>>> state(copy) == frozen, len(copy.data), len(calc.data)
+(True, 70, 10)
+
+Снимок снимка и изменения самого снимка:
+
+>>> second = copy.snapshot(dates[30])
+>>> frozen_second = state(second)
+>>> copy.remove_payment(dates[5])
+>>> copy.new_payment({date: Storage((30000, 0), False)
+...                   for date in dates[5:40]})
+>>> ign = copy.totals()
+>>> state(second) == frozen_second, len(second.data), len(calc.data)
+(True, 30, 10)
+>>> copy.data.truncate(dates[0])
+>>> state(second) == frozen_second, len(copy.data)
+(True, 0)
+""",
+    'payoff': """
+Бинарный поиск _payoff_offset совпадает с прямым перебором по месяцам
+(как в advanced_repayment_date), в том числе для платежей на границе:
+на копейку меньше и больше наименьшего платежа, гасящего долг к
+месяцу, - и для погашения ровно в последний месяц срока. None (нужен
+перебор) - только там, где оценка погрешности не даёт ответа.
+
+>>> import random
+>>> def linear_offset(calc, payment, limit=None):
+...     offset = months(calc.first_date, calc.date)
+...     loan_sum = calc.loan_sum
+...     dates, ratios = calc._calendar(calc.first_period)
+...     while loan_sum > payment and (limit is None or offset <= limit):
+...         if offset == len(ratios):
+...             dates, ratios = calc._calendar(offset)
+...         loan_sum -= payment - round(loan_sum * calc.percent *
+...                                     ratios[offset], 2)
+...         offset += 1
+...     return offset
+>>> def boundary(calc, target):
+...     # наименьший платеж (в копейках), гасящий долг к месяцу target
+...     low, high = 0, int(calc.loan_sum * 100) + 1
+...     while high - low > 1:
+...         middle = (low + high) // 2
+...         if linear_offset(calc, middle / 100, target) <= target:
+...             high = middle
+...         else:
+...             low = middle
+...     return high
+>>> random.seed(4)
+>>> errors = []
+>>> checked = fallback = last_period = 0
+>>> for k in range(30):
+...     calc = Calculation(
+...         datetime.date(random.randint(2000, 2020), random.randint(1, 12),
+...                       random.randint(1, 28)),
+...         random.randint(100, 5000) * 1000, random.uniform(3, 20),
+...         random.choice((60, 120, 240)))
+...     if k % 2:
+...         calc.new_payment({
+...             date: Storage((round(calc.first_annuity * 1.5, 2),),
+...                           random.random() < 0.5)
+...             for date in calc._calendar(12)[0][1:13]})
+...     start = months(calc.first_date, calc.date)
+...     targets = random.sample(range(start + 1, calc.first_period - 1), 4)
+...     for target in targets + [calc.first_period - 1]:
+...         cents = boundary(calc, target)
+...         for payment in (cents - 1, cents, cents + 1):
+...             expected = linear_offset(calc, payment / 100)
+...             offset = calc._payoff_offset(payment / 100)
+...             checked += 1
+...             fallback += offset is None
+...             if offset is not None and offset != expected:
+...                 errors.append((k, payment))
+...             if target == calc.first_period - 1 and payment == cents:
+...                 last_period += expected + 1 == calc.first_period
+>>> errors, checked, fallback < checked // 2, last_period
+([], 450, True, 30)
+""",
+}
+
+
 if __name__ == "__main__":
     main()
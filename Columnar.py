@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# This program or module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version. It is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""Двоичный столбцовый файл посчитанных графиков платежей (.mcs).
+
+Файл хранит истории многих кредитов по столбцам фиксированной ширины
+(little-endian, каждый столбец выровнен на 8 байт):
+
+    MCSCHED1 | столбцы кредита 1 | столбцы кредита 2 | ... |
+    индекс (JSON) | смещение индекса (8 байт) | длина индекса (8 байт) |
+    MCSCHED1
+
+Индекс - условия каждого кредита, имена плательщиков, число платежей
+и смещение каждого столбца. Столбцы: date (int32, порядковый номер
+дня), recalc (uint8), period (int32), суммы (float64, как в Storage) и
+payment.0, payment.1, ... - платежи каждого плательщика (float64).
+
+Файл пишется потоком (кредиты по одному, индекс - в конце), а читается
+через mmap: ScheduleFile.column отдаёт столбец одного кредита без
+копирования (массив NumPy или memoryview), не трогая остальные.
+Файлы .clc (журналы и старые pickle) переводятся в этот формат:
+
+    python3 Columnar.py portfolio.mcs history1.clc history2.clc ...
+"""
+
+__all__ = ['COLUMNS', 'ScheduleFile', 'convert', 'main', 'write']
+
+import argparse
+import array
+import datetime
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from Journal import Journal, is_journal
+
+
+MAGIC = b'MCSCHED1'
+VERSION = 1
+
+# столбцы и их тип (код array / struct); платежи плательщиков -
+# отдельные столбцы payment.<номер> типа 'd'
+COLUMNS = (('date', 'i'), ('recalc', 'B'), ('period', 'i'),
+           ('loan_sum', 'd'), ('loan_payment', 'd'), ('bank_interest', 'd'),
+           ('annuity', 'd'), ('the_rest', 'd'), ('overpayment', 'd'),
+           ('profit_bp', 'd'))
+
+_FOOTER = struct.Struct('<QQ8s')
+
+
+def write(filename, histories):
+    """Пишет графики платежей в файл .mcs.
+
+    histories - итерируемое пар (имя кредита, {'together': Calculation,
+    имя плательщика: Calculation, ...}) или (имя, (имена плательщиков,
+    расчёты)); перебирается один раз, в памяти держится один кредит.
+    Возвращает число записанных кредитов.
+    """
+    loans = []
+    with open(filename, 'wb') as fh:
+        fh.write(MAGIC)
+        for name, calc in histories:
+            names = ()
+            if isinstance(calc, tuple):
+                names, calc = calc
+            loans.append(_write_loan(fh, name, tuple(names), calc))
+        index = json.dumps({'version': VERSION, 'loans': loans},
+                           ensure_ascii=False).encode('utf-8')
+        offset = fh.tell()
+        fh.write(index)
+        fh.write(_FOOTER.pack(offset, len(index), MAGIC))
+    return len(loans)
+
+
+def convert(filename, sources):
+    """Переводит файлы .clc (журналы и старые pickle) в один файл .mcs.
+
+    Имя кредита - имя исходного файла без расширения.
+    """
+    return write(filename, ((os.path.splitext(os.path.basename(source))[0],
+                             _load_clc(source)) for source in sources))
+
+
+class ScheduleFile:
+    """Файл .mcs, открытый через mmap (только чтение).
+
+    Индекс читается при открытии; столбцы - по запросу, без копирования.
+    Пока живы полученные столбцы, файл закрыть нельзя (BufferError).
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length, magic = _FOOTER.unpack_from(
+            self._mmap, len(self._mmap) - _FOOTER.size)
+        if self._mmap[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            self.close()
+            raise ValueError('{0}: это не файл графиков платежей'.format(
+                filename))
+        index = json.loads(self._mmap[offset:offset + length].decode('utf-8'))
+        if index['version'] > VERSION:
+            self.close()
+            raise ValueError('{0}: неизвестная версия {1}'.format(
+                filename, index['version']))
+        self.loans = index['loans']
+        self._names = {loan['name']: i for i, loan in enumerate(self.loans)}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def __len__(self):
+        return len(self.loans)
+
+
+    def close(self):
+        """Закрывает файл."""
+        self._mmap.close()
+        self._file.close()
+
+
+    def column(self, loan, name):
+        """Столбец name кредита loan (номер или имя) без копирования.
+
+        Массив NumPy, если он установлен, иначе memoryview нужного типа.
+        Для date - порядковые номера дней (см. dates).
+        """
+        info = self.loans[self._names[loan] if isinstance(loan, str) \
+                          else loan]
+        offset = info['columns'][name]
+        typecode = 'd' if name.startswith('payment.') else \
+                   dict(COLUMNS)[name]
+        if numpy is not None:
+            return numpy.frombuffer(self._mmap, '<' + typecode,
+                                    info['rows'], offset)
+        size = struct.calcsize('<' + typecode)
+        view = memoryview(self._mmap)[offset:offset + info['rows']*size]
+        if sys.byteorder != 'little':
+            values = array.array(typecode, view)
+            values.byteswap()
+            return memoryview(values)
+        return view.cast(typecode)
+
+
+    def dates(self, loan):
+        """Даты платежей кредита (список datetime.date)."""
+        return [datetime.date.fromordinal(int(ordinal)) \
+                for ordinal in self.column(loan, 'date')]
+
+
+def main(argv=None):
+    """Точка входа командной строки: перевод .clc в .mcs."""
+    parser = argparse.ArgumentParser(
+        description='Перевод историй платежей (.clc) в столбцовый файл.')
+    parser.add_argument('output', help='файл графиков платежей (.mcs)')
+    parser.add_argument('sources', nargs='+', help='истории платежей (.clc)')
+    args = parser.parse_args(argv)
+    try:
+        count = convert(args.output, args.sources)
+    except (EnvironmentError, pickle.PickleError, ValueError,
+            KeyError) as err:
+        print('Ошибка: {0}'.format(err), file=sys.stderr)
+        return 1
+    print('Кредитов: {0}'.format(count), file=sys.stderr)
+    return 0
+
+
+def _load_clc(filename):
+    """Имена плательщиков и расчёты из файла .clc любого формата."""
+    if is_journal(filename):
+        return Journal(filename).load()
+    with open(filename, 'rb') as fh:
+        return pickle.load(fh), pickle.load(fh)
+
+
+def _write_loan(fh, name, names, calc):
+    """Пишет столбцы одного кредита; возвращает его запись индекса."""
+    together = calc['together']
+    history = together.data
+    payers = history.payers or len(names)
+    payments = history.column('payment')
+    columns = [(column, array.array(typecode, history.column(column))) \
+               for column, typecode in COLUMNS]
+    columns.extend(('payment.{0}'.format(k),
+                    array.array('d', payments[k::payers])) \
+                   for k in range(payers))
+    offsets = {}
+    for column, values in columns:
+        fh.write(bytes(-fh.tell() % 8))
+        offsets[column] = fh.tell()
+        if sys.byteorder != 'little':
+            values.byteswap()
+        values.tofile(fh)
+    return {'name': name, 'first_date': str(together.first_date),
+            'loan_sum': together.first_loan_sum,
+            'percent': together.percent * 100,
+            'period': together.first_period, 'payers': list(names),
+            'last_date': str(together.date), 'balance': together.loan_sum,
+            'rows': len(history), 'columns': offsets}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+# This program or module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version. It is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""Пакетный расчёт графика платежей (истории и прогноза) по столбцам.
+
+Календарь платежей, коэффициенты дней и суммы платежей считаются
+векторно (через NumPy, если он установлен). Сам пересчёт долга -
+рекуррентный (каждый шаг округляется до копеек), поэтому он идёт
+одним проходом по плоским спискам, без создания объектов на каждый месяц.
+Тот же пересчёт может идти в целых копейках (amortize_kopecks): ставка
+и доли дней - точные дроби, округление - явное (см. round_div).
+"""
+
+__all__ = ['Schedule', 'State', 'Sweep', 'amortize', 'amortize_joint',
+           'amortize_kopecks', 'annuity_factor', 'annuity_kopecks',
+           'annuity_payment', 'day_fractions', 'payment_calendar',
+           'project', 'project_rows', 'round_div', 'sweep', 'to_kopecks']
+
+import calendar
+import collections
+import fractions
+import functools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from MyDateLib import date_plus_months, days_in_year
+
+
+# Столбцы графика платежей. dates - даты списания, payment - сумма
+# внесённая всеми плательщиками, остальное - как в Storage.
+Schedule = collections.namedtuple(
+    'Schedule', 'dates payment loan_payment bank_interest annuity loan_sum '
+                'period the_rest overpayment profit_bp')
+
+# Состояние расчёта после очередного платежа
+State = collections.namedtuple('State', 'loan_sum period annuity the_rest')
+
+# Варианты досрочного погашения (см. sweep): ежемесячный платеж, дата
+# последнего платежа, проценты банку до конца кредита и экономия на
+# процентах относительно банковского графика
+Sweep = collections.namedtuple('Sweep', 'payment dates interest savings')
+
+
+def annuity_payment(loan_sum, percent, period):
+    """Аннуитетный платеж (percent - годовая ставка в долях единицы).
+
+    Коэффициенты берутся из кэша (см. annuity_factor), сумма
+    считается по ним так же, как по полной формуле.
+
+    >>> annuity_payment(900000, 0.145, 120)
+    14245.81
+    """
+    numerator, denominator = annuity_factor(percent, period)
+    return round(loan_sum * numerator/denominator, 2)
+
+
+@functools.lru_cache(maxsize=4096)
+def annuity_factor(percent, period):
+    """Числитель и знаменатель аннуитетного коэффициента.
+
+    Платеж = loan_sum * numerator/denominator. Для одной ставки
+    периодов не больше срока кредита, поэтому кэш ограниченного
+    размера покрывает весь расчёт.
+
+    >>> annuity_factor(0.12, 1)
+    (0.0101, 0.010000000000000009)
+    """
+    i = percent/12 # проценты / месяцев_в_году
+    n = period
+    return i*(1+i)**n, ((1+i)**n) - 1
+
+
+def annuity_kopecks(loan_sum, rate, period):
+    """Аннуитетный платеж в копейках (loan_sum - в копейках).
+
+    rate - годовая ставка в долях единицы (дробь или число).
+    Коэффициент - тот же, что у annuity_payment; платеж округляется
+    до копейки половиной от нуля.
+
+    >>> annuity_kopecks(90000000, fractions.Fraction(29, 200), 120)
+    1424581
+    """
+    numerator, denominator = annuity_factor(float(rate), period)
+    value = loan_sum * numerator/denominator
+    return int(value + 0.5) if value >= 0 else -int(0.5 - value)
+
+
+def round_div(numerator, denominator):
+    """Целочисленное деление с округлением половины от нуля.
+
+    Правило округления до копеек в копеечном режиме (amortize_kopecks).
+
+    >>> round_div(5, 2), round_div(-5, 2), round_div(7, 3), round_div(-7, 3)
+    (3, -3, 2, -2)
+    """
+    quotient, remainder = divmod(abs(numerator) * 2 + abs(denominator),
+                                 abs(denominator) * 2)
+    return quotient if (numerator < 0) == (denominator < 0) else -quotient
+
+
+def to_kopecks(value):
+    """Сумма в рублях -> целое число копеек.
+
+    >>> to_kopecks(843060.41), to_kopecks(0.1 + 0.2)
+    (84306041, 30)
+    """
+    return int(round(value * 100))
+
+
+def payment_calendar(first_date, count, start=0):
+    """Даты платежей и коэффициенты дней для месяцев start..count.
+
+    dates[k] - дата (start+k)-го платежа (нулевой - дата оформления
+    договора), ratios[k] - отношение дней между этим и следующим платежом
+    к дням в году, с учётом стыка с високосным годом
+    (как в Calculation._ratio).
+
+    >>> import datetime
+    >>> dates, ratios = payment_calendar(datetime.date(2015, 12, 31), 2)
+    >>> [str(d) for d in dates]
+    ['2015-12-31', '2016-01-31', '2016-02-29']
+    >>> round(ratios[0], 6), round(ratios[1], 6)
+    (0.084699, 0.079235)
+    """
+    if numpy is None:
+        return _payment_calendar_py(first_date, count, start)
+    offsets = numpy.arange(start, count + 2)
+    month_starts = numpy.datetime64(
+        '{0:04d}-{1:02d}'.format(first_date.year, first_date.month), 'M') + \
+        numpy.arange(start, count + 3)
+    days_in_month = numpy.diff(
+        month_starts.astype('datetime64[D]')).astype(int)
+    month_starts = month_starts[:-1]
+    years = (first_date.year * 12 + first_date.month - 1 + offsets) // 12
+    january = month_starts.astype(int) % 12 == 0
+    days = numpy.minimum(first_date.day, days_in_month)
+    all_dates = month_starts.astype('datetime64[D]') + (days - 1)
+
+    leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+    year_days = numpy.where(leap, 366, 365)
+    delta = numpy.diff(all_dates).astype(int)
+    # следующий платеж в январе високосного года - период делится надвое
+    split = january[1:] & leap[1:]
+    ratios = numpy.where(
+        split,
+        (31 - days[:-1]) / year_days[:-1] + days[1:] / year_days[1:],
+        delta / year_days[1:])
+    return all_dates[:-1].tolist(), ratios.tolist()
+
+
+def _payment_calendar_py(first_date, count, start=0):
+    """То же, что payment_calendar, но без NumPy."""
+    dates = [date_plus_months(first_date, start, initdate=first_date)]
+    for ign in range(start, count + 1):
+        dates.append(date_plus_months(dates[-1], 1, initdate=first_date))
+    ratios = []
+    for date, next_date in zip(dates, dates[1:]):
+        if next_date.month == 1 and calendar.isleap(next_date.year):
+            break_date = date.replace(day=31)
+            k = (break_date - date).days / days_in_year(date.year) + \
+                (next_date - break_date).days / days_in_year(next_date.year)
+        else:
+            k = (next_date - date).days / days_in_year(next_date.year)
+        ratios.append(k)
+    return dates[:-1], ratios
+
+
+def day_fractions(dates):
+    """Точные доли дней между соседними датами платежей.
+
+    То же, что коэффициенты payment_calendar, но пара целых
+    (числитель, знаменатель): дней в периоде к дням в году, на стыке с
+    високосным годом - сумма двух дробей.
+
+    >>> import datetime
+    >>> dates = payment_calendar(datetime.date(2015, 12, 31), 2)[0]
+    >>> day_fractions(dates)
+    [(11315, 133590), (29, 366)]
+    """
+    parts = []
+    for date, next_date in zip(dates, dates[1:]):
+        if next_date.month == 1 and calendar.isleap(next_date.year):
+            break_date = date.replace(day=31)
+            first, second = days_in_year(date.year), \
+                            days_in_year(next_date.year)
+            parts.append(((break_date - date).days * second + \
+                          (next_date - break_date).days * first,
+                          first * second))
+        else:
+            parts.append(((next_date - date).days,
+                          days_in_year(next_date.year)))
+    return parts
+
+
+def amortize(percent, first_period, ratios, start, state, totals, recalcs,
+             arrays=True):
+    """Считает историю платежей одним проходом.
+
+    percent - годовая ставка (в долях), start - номер месяца первого
+    платежа, ratios - коэффициенты дней перед каждым платежом
+    (см. payment_calendar), state - состояние расчёта перед первым
+    платежом, totals - суммы платежей по месяцам, recalcs - флаги пересчёта.
+    Возвращает столбцы (Schedule без дат) и конечное состояние;
+    если arrays ложно - столбцы остаются списками.
+    """
+    [result] = amortize_joint(percent, first_period, ratios, start, [state],
+                              [totals], recalcs, arrays)
+    return result
+
+
+def amortize_joint(percent, first_period, ratios, start, states, totals,
+                   recalcs, arrays=True):
+    """То же, что amortize, но для нескольких расчётов сразу.
+
+    Расчёты (общий и по каждому плательщику) идут по одним датам с
+    одной ставкой и флагами пересчёта и отличаются только долгом и
+    платежами: states[k] и totals[k] - для k-го расчёта. Все они
+    считаются за один проход по месяцам; возвращается список пар
+    (Schedule, State), по одной на каждый расчёт.
+    """
+    # ставка в том виде, как её получал Calculation для расчёта экономии
+    profit_percent = percent * 100 / 100
+    states = [list(state) for state in states]
+    columns = [[[] for ign in range(9)] for state in states]
+    for i, (offset, ratio, recalc) in enumerate(
+            zip(range(start, start + len(recalcs)), ratios, recalcs)):
+        for state, calc_totals, (
+                payments, loan_payments, bank_interests, annuities,
+                loan_sums, periods, rests, overpayments, profits) in zip(
+                    states, totals, columns):
+            loan_sum, period, annuity, the_rest = state
+            total = calc_totals[i]
+            bank_interest = round(loan_sum * percent * ratio, 2)
+            loan_payment = round(annuity - bank_interest, 2)
+            loan_sum = round(loan_sum - loan_payment, 2)
+            annuities.append(annuity)
+            if recalc:
+                overpayment = round(total - annuity + the_rest*1.005, 2)
+                loan_sum = loan_sum - overpayment
+                period = first_period - offset
+                profit = round(annuity_payment(
+                    overpayment, profit_percent, period) * period - \
+                               overpayment, 2)
+                annuity = annuity_payment(loan_sum, percent, period)
+                the_rest = 0
+            else:
+                the_rest = round(total - annuity + the_rest*1.005, 2)
+                overpayment = 0
+                profit = 0
+            state[:] = loan_sum, period, annuity, the_rest
+            payments.append(total)
+            loan_payments.append(loan_payment)
+            bank_interests.append(bank_interest)
+            loan_sums.append(loan_sum)
+            periods.append(period)
+            rests.append(the_rest)
+            overpayments.append(overpayment)
+            profits.append(profit)
+    results = []
+    for state, calc_columns in zip(states, columns):
+        if arrays:
+            calc_columns = [_array(column, int if k == 5 else float) \
+                            for k, column in enumerate(calc_columns)]
+        results.append((Schedule(None, *calc_columns), State(*state)))
+    return results
+
+
+def amortize_kopecks(percent, first_period, parts, start, states, totals,
+                     recalcs):
+    """То же, что amortize_joint, но в целых копейках.
+
+    Суммы в states и totals и все суммы результата - целые копейки,
+    parts - точные доли дней (см. day_fractions), percent - годовая
+    ставка в долях единицы (переводится в точную дробь). Проценты банку
+    считаются без погрешности и округляются явно (round_div), поэтому
+    результат не зависит от накопленной погрешности float.
+    """
+    rate = fractions.Fraction(percent).limit_denominator(10**6)
+    rate_numerator, rate_denominator = rate.numerator, rate.denominator
+    states = [list(state) for state in states]
+    columns = [[[] for ign in range(9)] for state in states]
+    for i, (offset, (days, year), recalc) in enumerate(
+            zip(range(start, start + len(recalcs)), parts, recalcs)):
+        denominator = rate_denominator * year
+        for state, calc_totals, (
+                payments, loan_payments, bank_interests, annuities,
+                loan_sums, periods, rests, overpayments, profits) in zip(
+                    states, totals, columns):
+            loan_sum, period, annuity, the_rest = state
+            total = calc_totals[i]
+            bank_interest = round_div(loan_sum * rate_numerator * days,
+                                      denominator)
+            loan_payment = annuity - bank_interest
+            loan_sum -= loan_payment
+            annuities.append(annuity)
+            # остаток на счёте растёт на 0,5% в месяц
+            carried = total - annuity + round_div(the_rest * 1005, 1000)
+            if recalc:
+                overpayment = carried
+                loan_sum -= overpayment
+                period = first_period - offset
+                profit = annuity_kopecks(overpayment, rate, period) * \
+                         period - overpayment
+                annuity = annuity_kopecks(loan_sum, rate, period)
+                the_rest = 0
+            else:
+                the_rest = carried
+                overpayment = 0
+                profit = 0
+            state[:] = loan_sum, period, annuity, the_rest
+            payments.append(total)
+            loan_payments.append(loan_payment)
+            bank_interests.append(bank_interest)
+            loan_sums.append(loan_sum)
+            periods.append(period)
+            rests.append(the_rest)
+            overpayments.append(overpayment)
+            profits.append(profit)
+    return [(Schedule(None, *calc_columns), State(*state)) \
+            for state, calc_columns in zip(states, columns)]
+
+
+def project(first_date, percent, first_period, start, state, payment=None):
+    """Прогноз графика платежей от месяца start до конца кредита.
+
+    Если payment не задан - платится текущий аннуитетный платеж
+    (банковский график), иначе каждый месяц вносится payment с пересчётом.
+    Последний платеж закрывает остаток долга. Столбцы собираются
+    из project_rows.
+
+    Платеж, посчитанный под дату погашения, гасит долг в эту дату:
+
+    >>> import datetime
+    >>> from Calculation import Calculation
+    >>> calc = Calculation(datetime.date(2013, 7, 10), 900000, 14.5, 120)
+    >>> payment = calc.advanced_repayment_payment(datetime.date(2017, 1, 10))
+    >>> schedule = calc.projection(payment)
+    >>> str(schedule.dates[-1]), float(schedule.payment[-1])
+    ('2017-01-10', 27459.61)
+    """
+    columns = [[] for ign in range(10)]
+    for row in project_rows(first_date, percent, first_period, start, state,
+                            payment):
+        for column, value in zip(columns, row):
+            column.append(value)
+    return Schedule(columns[0], *[
+        _array(column, int if k == 5 else float) \
+        for k, column in enumerate(columns[1:])])
+
+
+def project_rows(first_date, percent, first_period, start, state,
+                 payment=None):
+    """То же, что project, но по одному месяцу (генератор Schedule).
+
+    Каждая строка - Schedule из значений одного месяца; месяцы
+    считаются по мере обхода, весь прогноз в памяти не хранится.
+    """
+    loan_sum, period, annuity, the_rest = state
+    if start > first_period:
+        dates, ratios = [], []
+    else:
+        dates, ratios = payment_calendar(first_date, first_period, start - 1)
+    profit_percent = percent * 100 / 100
+    for offset, date, ratio in zip(range(start, first_period + 1),
+                                   dates[1:], ratios):
+        if loan_sum <= 0:
+            break
+        bank_interest = round(loan_sum * percent * ratio, 2)
+        pay = annuity if payment is None else max(payment, annuity)
+        overpayment = profit = 0
+        month_annuity = annuity
+        if loan_sum <= pay or offset == first_period:
+            # последний платеж закрывает долг (вместе с процентами
+            # месяца - как в Calculation.advanced_repayment_date, чтобы
+            # копейки от округлений не уходили в лишний месяц)
+            loan_payment = loan_sum
+            pay = round(loan_sum + bank_interest, 2)
+            loan_sum = 0
+        else:
+            loan_payment = round(annuity - bank_interest, 2)
+            loan_sum = round(loan_sum - loan_payment, 2)
+            if pay > annuity:
+                overpayment = round(pay - annuity, 2)
+                loan_sum = loan_sum - overpayment
+                period = first_period - offset
+                profit = round(annuity_payment(
+                    overpayment, profit_percent, period) * period - \
+                               overpayment, 2)
+                annuity = annuity_payment(loan_sum, percent, period)
+        yield Schedule(date, pay, loan_payment, bank_interest, month_annuity,
+                       loan_sum, period, 0, overpayment, profit)
+
+
+def sweep(first_date, percent, first_period, start, state, payments,
+          workers=None):
+    """Прогноз (см. project) сразу для набора ежемесячных платежей.
+
+    Возвращает столбцы Sweep по одному значению на каждый платеж.
+    Все варианты идут вместе, месяц за месяцем, векторно по вариантам
+    (если есть NumPy; копейки округляются так же, как в project).
+    Если workers больше 1 - варианты делятся между процессами.
+    """
+    payments = list(payments)
+    # банковский график - это платеж, равный текущему аннуитетному
+    base_interest = round(_sweep(first_date, percent, first_period, start,
+                                 state, [state.annuity])[1][0], 2)
+    if workers is not None and workers > 1 and len(payments) > 1:
+        # пул процессов нужен редко, а импорт concurrent.futures тянет за
+        # собой logging и threading - поэтому только здесь
+        import concurrent.futures
+        size = -(-len(payments) // workers)
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            parts = list(executor.map(
+                functools.partial(_sweep, first_date, percent, first_period,
+                                  start, state),
+                [payments[k:k + size] \
+                 for k in range(0, len(payments), size)]))
+    else:
+        parts = [_sweep(first_date, percent, first_period, start, state,
+                        payments)]
+    offsets = [offset for part in parts for offset in part[0]]
+    interests = [round(interest, 2) for part in parts for interest in part[1]]
+    dates = payment_calendar(first_date, max(offsets + [0]))[0]
+    return Sweep(payments,
+                 [None if offset < start else dates[offset] \
+                  for offset in offsets],
+                 interests,
+                 [round(base_interest - interest, 2) \
+                  for interest in interests])
+
+
+def _sweep(first_date, percent, first_period, start, state, payments):
+    """Месяц последнего платежа и сумма процентов для каждого платежа."""
+    if numpy is None or start > first_period:
+        offsets, interests = [], []
+        for payment in payments:
+            schedule = project(first_date, percent, first_period, start,
+                               state, payment)
+            offsets.append(start + len(schedule.payment) - 1)
+            interests.append(float(sum(schedule.bank_interest)))
+        return offsets, interests
+
+    ratios = payment_calendar(first_date, first_period, start - 1)[1]
+    payment = numpy.array(payments, dtype=float)
+    loan_sum = numpy.full(len(payment), float(state.loan_sum))
+    annuity = numpy.full(len(payment), float(state.annuity))
+    interest = numpy.zeros(len(payment))
+    last = numpy.full(len(payment), start - 1)
+    for offset, ratio in zip(range(start, first_period + 1), ratios):
+        active = loan_sum > 0
+        if not active.any():
+            break
+        bank_interest = _round_cents(loan_sum * percent * ratio)
+        pay = numpy.maximum(payment, annuity)
+        close = active & ((loan_sum <= pay) | (offset == first_period))
+        going = active & ~close
+        over = going & (pay > annuity)
+        interest += numpy.where(active, bank_interest, 0)
+        last[active] = offset
+        loan_sum = numpy.where(
+            going, _round_cents(loan_sum - _round_cents(
+                annuity - bank_interest)), 0)
+        loan_sum = numpy.where(
+            over, loan_sum - _round_cents(pay - annuity), loan_sum)
+        if over.any():
+            numerator, denominator = annuity_factor(percent,
+                                                    first_period - offset)
+            annuity = numpy.where(
+                over, _round_cents(loan_sum * numerator/denominator),
+                annuity)
+    return last.tolist(), interest.tolist()
+
+
+def _round_cents(values):
+    """Округление массива NumPy до копеек - как round(x, 2) у каждого.
+
+    numpy.round умножает на 100 и округляет, и около половины копейки
+    может разойтись с round; такие значения округляются через round.
+
+    >>> values = [8934.935, 8265.385, 1966.505, 12.5]
+    >>> numpy is None or _round_cents(numpy.array(values)).tolist() == \\
+    ...     [round(x, 2) for x in values]
+    True
+    """
+    cents = values * 100
+    result = numpy.rint(cents) / 100
+    near = numpy.abs(cents - numpy.floor(cents) - 0.5) <= \
+           1e-12 * (1 + numpy.abs(cents))
+    for i in numpy.flatnonzero(near):
+        result[i] = round(float(values[i]), 2)
+    return result
+
+
+def _array(values, type_=float):
+    """Столбец: массив NumPy, если он есть, иначе обычный список."""
+    if numpy is None:
+        return values
+    return numpy.array(values, dtype=type_)
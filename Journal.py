@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# This program or module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version. It is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""Журнал ипотечной истории: условия кредита и внесённые платежи.
+
+Файл журнала - текст в UTF-8, по записи JSON на строку:
+
+    MORTGAGE-JOURNAL 1
+    {"first_date": "2013-07-03", "loan_sum": 900000, "percent": 14.5,
+     "period": 120, "names": ["Иван", "Мария"], "loans": [450000, 450000],
+     "kopecks": false}
+    {"add": [["2013-08-03", [65000, 0], true], ...]}
+    {"truncate": "2013-09-03"}
+
+Хранятся только исходные данные (даты, платежи плательщиков и флаги
+пересчёта), а не посчитанные Storage. При сохранении в конец файла
+дописывается только разница с прошлым сохранением (add - новые
+платежи, truncate - удаление хвоста истории перед изменёнными
+платежами). При загрузке записи повторяются по порядку: truncate -
+Calculation.remove_payment, add - один Calculation.new_payment.
+remove_payment пересчитывает аннуитет, поэтому платежи, внесённые
+после удаления (см. Calculation.restarts), пишутся после своего
+truncate - и после загрузки история считается так же, как до
+сохранения. Когда записей становится много, журнал переписывается
+заново (compact).
+"""
+
+__all__ = ['Journal', 'dumps', 'is_journal', 'loads']
+
+import datetime
+import json
+import os
+
+from Calculation import Calculation, Storage
+
+
+MAGIC = 'MORTGAGE-JOURNAL'
+VERSION = 1
+
+
+def dumps(names, calc):
+    """Журнал истории одной строкой: заголовок и записи add.
+
+    Запись add одна, если история ни разу не начиналась заново после
+    удаления платежей (иначе - add, truncate, add...).
+    """
+    lines = ['{0} {1}\n'.format(MAGIC, VERSION),
+             json.dumps(_header(names, calc), ensure_ascii=False) + '\n']
+    lines.extend(json.dumps(record, ensure_ascii=False) + '\n' \
+                 for record in _records(_entries(calc)))
+    return ''.join(lines)
+
+
+def loads(text):
+    """Имена плательщиков и расчёты из текста журнала (см. dumps).
+
+    >>> import datetime
+    >>> from Calculation import Storage
+    >>> day = lambda month: datetime.date(2013 + (month - 1)//12,
+    ...                                   (month - 1)%12 + 1, 3)
+    >>> names, calc = loads(dumps(['Иван'], {
+    ...     'together': Calculation(day(7), 900000, 14.5, 120),
+    ...     'Иван': Calculation(day(7), 900000, 14.5, 120)}))
+    >>> calc['together'].new_payment(
+    ...     {day(m): Storage((90000 if m == 9 else 15000,), m == 9)
+    ...      for m in range(8, 14)}, payers=[calc['Иван']])
+
+    Удаление и повторный ввод тех же платежей меняют расчёт (аннуитет
+    пересчитывается remove_payment), и журнал это сохраняет:
+
+    >>> for one in calc.values():
+    ...     one.remove_payment(day(11))
+    >>> calc['together'].new_payment(
+    ...     {day(m): Storage((15000,), False) for m in range(11, 14)},
+    ...     payers=[calc['Иван']])
+    >>> calc['together'].restarts() == [day(11)]
+    True
+    >>> state = lambda calc: {name: (one.loan_sum, one.actualy_annuity,
+    ...                              list(one.data.column('annuity')))
+    ...                       for name, one in calc.items()}
+    >>> state(loads(dumps(names, calc))[1]) == state(calc)
+    True
+
+    Журнал, оборванный до конца заголовка, - ValueError, как и любой
+    другой повреждённый файл:
+
+    >>> for text in ('', MAGIC, '{0} {1}\\n'.format(MAGIC, VERSION)):
+    ...     try:
+    ...         loads(text)
+    ...     except ValueError as err:
+    ...         print(err)
+    файл повреждён
+    файл повреждён
+    файл повреждён
+    """
+    header, records, count, torn = _read(iter(text.splitlines(True)))
+    return _replay(header, records)
+
+
+def is_journal(filename):
+    """Является ли файл журналом (а не старым файлом pickle)."""
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC.encode('ascii')
+
+
+class Journal:
+    """Журнал одной ипотечной истории, привязанный к файлу.
+
+    Помнит, какие платежи уже записаны в файл, чтобы save дописывал
+    только изменения.
+    """
+
+    # после стольких записей журнал переписывается заново
+    COMPACT_RECORDS = 64
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = None
+        self.records = 0
+        self._saved = []    # см. _entries
+
+
+    def load(self):
+        """Читает журнал: (имена плательщиков, {имя: Calculation}).
+
+        Как и раньше в файлах .clc, общий расчёт - под ключом 'together'.
+        Недописанная последняя строка (например, после сбоя) пропускается,
+        а следующее сохранение перепишет журнал целиком.
+        """
+        with open(self.filename, encoding='utf-8') as fh:
+            header, records, count, torn = _read(fh)
+        if torn:
+            # дописывать после обрывка нельзя - журнал перепишется
+            count = self.COMPACT_RECORDS
+        names, calc = _replay(header, records)
+        self.header = header
+        self.records = count
+        self._saved = _entries(calc)
+        return names, calc
+
+
+    def save(self, names, calc):
+        """Дописывает в журнал изменения с прошлого сохранения.
+
+        Если файла ещё нет, условия кредита изменились или записей
+        накопилось много - журнал переписывается целиком (compact).
+        Изменённые платежи дописываются после truncate с платежа, перед
+        которым remove_payment даёт тот же аннуитет, что и в расчёте
+        (см. _cut). Возвращает число дописанных записей.
+
+        >>> import datetime, tempfile
+        >>> from Calculation import Storage
+        >>> day = lambda month: datetime.date(2013 + (month - 1)//12,
+        ...                                   (month - 1)%12 + 1, 3)
+        >>> def add(calc, months, recalc=()):
+        ...     calc['together'].new_payment(
+        ...         {day(m): Storage((15000, 5000 if m in recalc else 0),
+        ...                          m in recalc) for m in months},
+        ...         payers=[calc['Иван'], calc['Мария']])
+        >>> def remove(calc, month):
+        ...     for one in calc.values():
+        ...         one.remove_payment(day(month))
+        >>> def state(calc):
+        ...     return {name: (one.loan_sum, one.actualy_annuity,
+        ...                    list(one.data.column('annuity')))
+        ...             for name, one in calc.items()}
+        >>> names = ['Иван', 'Мария']
+        >>> calc = {'together': Calculation(day(7), 900000, 14.5, 120),
+        ...         'Иван': Calculation(day(7), 450000, 14.5, 120),
+        ...         'Мария': Calculation(day(7), 450000, 14.5, 120)}
+        >>> add(calc, range(8, 14), recalc=(9,))
+        >>> folder = tempfile.TemporaryDirectory()
+        >>> journal = Journal(os.path.join(folder.name, 'loan.clc'))
+        >>> journal.save(names, calc)
+        1
+
+        Удаление и повторный ввод тех же платежей: данные те же, но
+        расчёт другой - журнал дописывает truncate перед ними.
+
+        >>> remove(calc, 11)
+        >>> add(calc, range(11, 14))
+        >>> journal.save(names, calc)
+        2
+        >>> state(Journal(journal.filename).load()[1]) == state(calc)
+        True
+
+        Удаление хвоста и новые платежи поверх старой истории:
+
+        >>> remove(calc, 13)
+        >>> journal.save(names, calc)
+        1
+        >>> state(Journal(journal.filename).load()[1]) == state(calc)
+        True
+        >>> add(calc, range(13, 16))
+        >>> remove(calc, 10)
+        >>> add(calc, range(10, 18), recalc=(12,))
+        >>> journal.save(names, calc) > 0
+        True
+        >>> state(Journal(journal.filename).load()[1]) == state(calc)
+        True
+        >>> journal.save(names, calc)
+        0
+        >>> folder.cleanup()
+        """
+        header = _header(names, calc)
+        if header != self.header or not os.path.exists(self.filename) or \
+           self.records >= self.COMPACT_RECORDS:
+            self.compact(names, calc)
+            return 1
+        entries = _entries(calc)
+        same = 0
+        for old, new in zip(self._saved, entries):
+            if old != new:
+                break
+            same += 1
+        if same == len(entries) == len(self._saved):
+            return 0
+        # последняя запись _entries - не платеж: если она не требовала
+        # truncate, записанное до неё остаётся, и новое только дописывается
+        if same < len(self._saved) - 1 or self._saved[-1][3]:
+            cut = _cut(calc, entries, same)
+            records = _records(entries[cut:], self._saved[cut][0])
+        else:
+            records = _records(entries[same:])
+        if records:
+            with open(self.filename, 'a', encoding='utf-8') as fh:
+                for record in records:
+                    fh.write(json.dumps(record, ensure_ascii=False) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+        self.records += len(records)
+        self._saved = entries
+        return len(records)
+
+
+    def compact(self, names, calc):
+        """Переписывает журнал: заголовок и записи со всеми платежами (dumps).
+
+        Пишется во временный файл, который затем заменяет журнал.
+        """
+        header = _header(names, calc)
+        entries = _entries(calc)
+        temp = self.filename + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as fh:
+            fh.write(dumps(names, calc))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp, self.filename)
+        self.header = header
+        self.records = len(_records(entries))
+        self._saved = entries
+
+
+def _date(text):
+    """Дата ГГГГ-ММ-ДД."""
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def _header(names, calc):
+    """Заголовок журнала: условия кредита и плательщики."""
+    together = calc['together']
+    return {'first_date': str(together.first_date),
+            'loan_sum': together.first_loan_sum,
+            'percent': together.percent * 100,
+            'period': together.first_period,
+            'names': list(names),
+            'loans': [calc[name].first_loan_sum for name in names],
+            'kopecks': together.kopecks}
+
+
+def _item(payment):
+    """Платеж для записи в журнал: [дата, [платежи], пересчёт]."""
+    date, payments, recalc = payment
+    return [str(date), list(payments), recalc]
+
+
+def _payment(item):
+    """Платеж из записи журнала: (дата, кортеж платежей, пересчёт)."""
+    date, payments, recalc = item
+    return _date(date), tuple(payments), bool(recalc)
+
+
+def _payments(calc):
+    """Исходные данные истории: [(дата, платежи, пересчёт), ...].
+
+    Берутся из столбцов истории (History.column), без создания Storage.
+    """
+    history = calc.data
+    payers = history.payers or 0
+    values = history.column('payment')
+    return [(datetime.date.fromordinal(ordinal),
+             tuple(values[i*payers:(i + 1)*payers]), bool(recalc)) \
+            for i, (ordinal, recalc) in enumerate(
+                zip(history.column('date'), history.column('recalc')))]
+
+
+def _entries(calc):
+    """Что журнал должен повторить: платежи и перезапуски расчёта.
+
+    [(дата, платежи, пересчёт, перезапуск), ...] по платежам общего
+    расчёта; перезапуск - нужен ли перед датой remove_payment хотя бы
+    одному из расчётов (см. Calculation.restarts). Последняя запись -
+    (дата, None, False, True), если аннуитет сброшен после последнего
+    платежа, иначе (None, None, False, False).
+    """
+    restarts = set()
+    for one in calc.values():
+        restarts.update(one.restarts())
+    entries = [payment + (payment[0] in restarts,) \
+               for payment in _payments(calc['together'])]
+    last = entries[-1][0] if entries else None
+    tail = [date for date in restarts if last is None or date > last]
+    entries.append((tail[0], None, False, True) if tail \
+                   else (None, None, False, False))
+    return entries
+
+
+def _cut(calc, entries, same):
+    """Место, с которого дописывать entries, расходящиеся с записанными
+    с номера same.
+
+    truncate перед платежом пересчитывает аннуитет (remove_payment),
+    поэтому отступаем к платежу, который и был посчитан от такого
+    аннуитета во всех расчётах (в худшем случае - к первому).
+    """
+    while same > 0 and not entries[same][3]:
+        date, payments = entries[same][:2]
+        if payments is None:
+            if all(one.actualy_annuity == one.annuity_payment() \
+                   for one in calc.values()):
+                break
+        elif all(one.data[date].annuity == one.checkpoint(date).annuity \
+                 for one in calc.values()):
+            break
+        same -= 1
+    return same
+
+
+def _records(entries, truncate=None):
+    """Записи журнала для entries (см. _entries).
+
+    Перед каждым перезапуском расчёта - truncate, платежи между
+    ними - одной записью add; truncate - дата, с которой удалить
+    записанные раньше платежи перед первой из entries.
+    """
+    records = []
+    items = []
+    for i, (date, payments, recalc, restart) in enumerate(entries):
+        if truncate and not i:
+            records.append({'truncate': str(truncate)})
+        elif restart:
+            if items:
+                records.append({'add': items})
+                items = []
+            records.append({'truncate': str(date)})
+        if payments is not None:
+            items.append(_item((date, payments, recalc)))
+    if items:
+        records.append({'add': items})
+    return records
+
+
+def _read(lines):
+    """Разбирает строки журнала: (заголовок, записи, записей, обрыв).
+
+    Обрыв - была ли последняя строка недописанной (она пропускается).
+    """
+    try:
+        magic, version = next(lines).split()
+    except (StopIteration, ValueError):
+        raise ValueError('файл повреждён')
+    if magic != MAGIC or int(version) > VERSION:
+        raise ValueError('неизвестный формат файла: {0} {1}'.format(
+            magic, version))
+    try:
+        header = json.loads(next(lines))
+    except StopIteration:
+        raise ValueError('файл повреждён')
+    records = []
+    for line in lines:
+        if not line.endswith('\n'):
+            return header, records, len(records), True
+        records.append(json.loads(line))
+    return header, records, len(records), False
+
+
+def _replay(header, records):
+    """Расчёты по заголовку и записям: truncate - remove_payment всех
+    расчётов, add - один проход new_payment."""
+    first_date = _date(header['first_date'])
+    kopecks = header.get('kopecks', False)
+    together = Calculation(first_date, header['loan_sum'], header['percent'],
+                           header['period'], kopecks=kopecks)
+    calc = {'together': together}
+    for name, loan_sum in zip(header['names'], header['loans']):
+        calc[name] = Calculation(first_date, loan_sum, header['percent'],
+                                 header['period'], kopecks=kopecks)
+    payers = [calc[name] for name in header['names']]
+    for record in records:
+        if 'truncate' in record:
+            date = _date(record['truncate'])
+            for one in calc.values():
+                one.remove_payment(date)
+        together.new_payment(
+            {date: Storage(payment, recalc) \
+             for date, payment, recalc in map(_payment,
+                                              record.get('add', ()))},
+            payers=payers)
+    return header['names'], calc
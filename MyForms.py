@@ -13,14 +13,14 @@
 __all__ = ['AddEditForm', 'PayerNames']
 
 import collections
-import copy
 import datetime
 import functools
 import locale
 import sys
 from tkinter import *
 
-from Calculation import Calculation, Storage
+from Calculation import Storage
+from Engine import to_kopecks
 from MyWidgets import IntegerEntry
 from MyDateLib import date_plus_months
 
@@ -70,7 +70,7 @@ class AddEditForm(Toplevel):
         self.result = {}
 
         self.__names = names
-        self.calculation = copy.deepcopy(calculation)
+        self.calculation = calculation.snapshot()
         self.date = self.calculation.date
 
         self.debt_is_end = False
@@ -300,8 +300,14 @@ class AddEditForm(Toplevel):
                     parent=self)
                 return False
             # сравниваю целые числа, т.к. аннуитетный платеж не считает
-            # настолько маленькие числа (1 рубль на 10 лет)
-            if int(sum(payments)) == int(loan + bank_interest):
+            # настолько маленькие числа (1 рубль на 10 лет); в копеечном
+            # режиме суммы точные - сравниваю копейки
+            if self.calculation.kopecks:
+                debt_is_end = to_kopecks(sum(payments)) == \
+                              to_kopecks(loan) + to_kopecks(bank_interest)
+            else:
+                debt_is_end = int(sum(payments)) == int(loan + bank_interest)
+            if debt_is_end:
                 messagebox.showinfo(
                     'Кредит закрыт',
                     ('Месяц: {0}. \nВ этом месяце кредит закрыт.\n'
@@ -15,9 +15,15 @@ __all__ = ['Display', 'PaymentTable', 'LoanData',
            'IntegerEntry', 'ValidatingEntry']
 
 import abc
+import bisect
 import collections
 import datetime
+import doctest
 import functools
+import os
+import sys
+import threading
+import unittest
 from tkinter import *
 
 from MyDateLib import correct_date, date_plus_months
@@ -424,13 +430,116 @@ class MySpinBoxDate(Frame):
             self.__setup_date()
 
 
+class _Worker:
+    """Расчёты вне главного потока Tk.
+
+    submit(func, callback) ставит расчёт в очередь из одного места:
+    новый запрос отменяет предыдущий, если тот ещё не начался, а
+    ответ уже начатого, но устаревшего расчёта выбрасывается. Запрос
+    уходит в поток через delay мс после последнего submit (быстрый
+    ввод сводится в один расчёт), а результат опрашивается через
+    after() и передаётся в callback в главном потоке.
+    """
+
+    # как часто главный поток проверяет, готов ли расчёт (мс)
+    POLL = 20
+
+    def __init__(self, widget, delay=150):
+        self.widget = widget
+        self.delay = delay
+        self._condition = threading.Condition()
+        self._request = None
+        self._result = None
+        self._running = None    # поколение запроса, который считается
+        self._generation = 0
+        self._pending = None    # id after() отложенного запроса
+        self._polling = None    # id after() опроса результата
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='advanced-repayment')
+        self._thread.start()
+
+
+    def submit(self, func, callback):
+        """Запрос: func() посчитать в потоке, callback(результат) - в Tk.
+
+        Если func бросает исключение, callback получает его вместо
+        результата.
+        """
+        self.cancel()
+        generation = self._generation
+        self._pending = self.widget.after(
+            self.delay, self.__start, generation, func, callback)
+
+
+    def cancel(self):
+        """Отменяет ещё не выполненный запрос и ответ на начатый."""
+        with self._condition:
+            self._generation += 1
+            self._request = None
+        if self._pending is not None:
+            self.widget.after_cancel(self._pending)
+            self._pending = None
+
+
+    def __start(self, generation, func, callback):
+        """Отдаёт отложенный запрос потоку и начинает ждать ответ."""
+        self._pending = None
+        with self._condition:
+            if generation != self._generation:
+                return
+            self._request = (generation, func, callback)
+            self._condition.notify()
+        if self._polling is None:
+            self._polling = self.widget.after(self.POLL, self.__poll)
+
+
+    def __poll(self):
+        """Забирает готовый результат (в главном потоке)."""
+        self._polling = None
+        with self._condition:
+            result, self._result = self._result, None
+            waiting = self._request is not None or self._running is not None
+        if result is not None:
+            generation, callback, value = result
+            if generation == self._generation:
+                callback(value)
+                return
+        if waiting:
+            self._polling = self.widget.after(self.POLL, self.__poll)
+
+
+    def _run(self):
+        """Поток расчётов."""
+        while True:
+            with self._condition:
+                while self._request is None:
+                    self._condition.wait()
+                generation, func, callback = self._request
+                self._request = None
+                self._running = generation
+            try:
+                value = func()
+            except Exception as err:
+                value = err
+            with self._condition:
+                self._running = None
+                if generation == self._generation:
+                    self._result = (generation, callback, value)
+
+
 class AdvancedRepayment(Frame):
-    """Класс для создания формы досрочного погашения."""
+    """Класс для создания формы досрочного погашения.
+
+    Платёж и дата считаются в отдельном потоке (_Worker) по копии
+    расчёта, поэтому ввод не ждёт вычислений.
+    """
 
     def __init__(self, parent, calc, *arg, **kw):
         """Графическая форма для получения платежа/даты досрочного погашения"""
         super(AdvancedRepayment, self).__init__(parent, *arg, **kw)
         self.calc = calc
+        self.worker = _Worker(self)
+        self.__calc = calc.snapshot(share_cache=False)
 
         self.configure(bg='light goldenrod')
 
@@ -472,6 +581,7 @@ class AdvancedRepayment(Frame):
     def set_changes(self, calc):
         """Устанавливает новые данные для вычислений."""
         self.calc = calc
+        self.__calc = calc.snapshot(share_cache=False)
         self.dateSpinBox.set_border_date(
             bottom=date_plus_months(
                 calc.first_date if not calc.data else max(calc.data), \
@@ -481,21 +591,45 @@ class AdvancedRepayment(Frame):
 
 
     def __calculation(self, initiator):
-        """Вычисляет значения запланированной даты от платежа (и наоборот)"""
+        """Вычисляет значения запланированной даты от платежа (и наоборот)
+
+        Расчёт отдаётся потоку; ответ выставляется в __set_payment или
+        __set_date, если за это время не было нового запроса.
+        """
 
+        calc = self.__calc
         if initiator == 'pp_date':
-            payment = self.calc.advanced_repayment_payment(
-                self.dateSpinBox.get_date())
-            self.ppVar.set(int(payment))
-            self.ppEntry['bg'] = 'white'
+            date = self.dateSpinBox.get_date()
+            self.worker.submit(
+                lambda: calc.advanced_repayment_payment(date),
+                self.__set_payment)
         elif initiator == 'pp_payment':
             payment = self.ppVar.get()
             if payment == '' or float(payment) < self.calc.actualy_annuity:
+                self.worker.cancel()
                 self.ppEntry['bg'] = 'pink'
                 return
-            planed_date = self.calc.advanced_repayment_date(float(payment))
-            self.ppEntry['bg'] = 'white'
-            self.dateSpinBox.set_date(planed_date)
+            self.worker.submit(
+                lambda: calc.advanced_repayment_date(float(payment)),
+                self.__set_date)
+
+
+    def __set_payment(self, payment):
+        """Выставляет посчитанный платёж."""
+        if isinstance(payment, Exception):
+            self.ppEntry['bg'] = 'pink'
+            return
+        self.ppVar.set(int(payment))
+        self.ppEntry['bg'] = 'white'
+
+
+    def __set_date(self, planed_date):
+        """Выставляет посчитанную дату последнего платежа."""
+        if isinstance(planed_date, Exception):
+            self.ppEntry['bg'] = 'pink'
+            return
+        self.ppEntry['bg'] = 'white'
+        self.dateSpinBox.set_date(planed_date)
 
 
 class LoanData(Frame):
@@ -582,8 +716,241 @@ class LoanData(Frame):
                 self.checkVar.set(new_data)
 
 
+class _RowVar:
+    """Галка строки таблицы: как IntVar, но без переменной Tcl.
+
+    Строк в истории может быть сколько угодно, а переменные Tcl нужны
+    только флажкам строк, которые сейчас видны (см. PaymentTable).
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value=0):
+        self.value = value
+
+
+    def get(self):
+        return self.value
+
+
+    def set(self, value):
+        self.value = int(value)
+
+
+class _TableRow:
+    """Виджеты одной строки таблицы платежей (из пула PaymentTable).
+
+    Строка не привязана к дате: при прокрутке она показывает то
+    один, то другой платёж (PaymentTable.__bind).
+    """
+
+    def __init__(self, table, names, command):
+        """command(строка) - вызывается при щелчке по галке."""
+        canvas = table.canvas
+        self.frame = Frame(canvas, bg='khaki')
+        self.var = IntVar()
+        self.check = Checkbutton(
+            self.frame, text='', variable=self.var, width=1, height=1,
+            bg='cornsilk', onvalue=1, offvalue=0,
+            command=lambda: command(self))
+        self.check.grid(row=0, column=0, padx=0, pady=0, sticky=EW)
+        self.cells = []
+        for i, width in enumerate((6, 16, 11, 13, 11, 14)):
+            lb = Label(self.frame, width=width, relief=GROOVE, justify=LEFT,
+                       bg='cornsilk')
+            lb.grid(row=0, column=i+1, padx=0, pady=0, sticky=EW)
+            self.cells.append(lb)
+
+        # extra info head
+        self.heads = []
+        for k, text in enumerate(
+            ('Плательщик:', "Платеж:", "Переплата:", "Экономия:", 'Долг:')):
+            slb = Label(self.frame, text=text, relief=GROOVE,
+                        justify=LEFT, bg='moccasin')
+            slb.grid(row=1, column=2+k, padx=0, pady=0, sticky=EW)
+            self.heads.append(slb)
+
+        # extra info: имя и платёж плательщика, его переплата, экономия
+        # и долг (вид 'once') или общие переплата и экономия ('together')
+        self.payments = []
+        self.once = []
+        for k, name in enumerate(names):
+            Label(self.frame, text=name, relief=GROOVE,
+                  justify=LEFT, bg='white', height=1).grid(
+                      row=2+k, column=2, padx=0, pady=0, sticky=EW)
+            lb = Label(self.frame, relief=GROOVE, justify=LEFT, bg='white')
+            lb.grid(row=2+k, column=3, padx=0, pady=0, sticky=EW)
+            self.payments.append(lb)
+            for column in range(4, 7):
+                lb = Label(self.frame, relief=GROOVE, justify=LEFT,
+                           bg='white')
+                lb.grid(row=2+k, column=column, sticky=NSEW)
+                self.once.append(lb)
+        self.together = []
+        for column in range(4, 6):
+            lb = Label(self.frame, relief=GROOVE, justify=LEFT, bg='white')
+            lb.grid(row=2, column=column, rowspan=len(names), sticky=NSEW)
+            self.together.append(lb)
+
+        self.item = canvas.create_window(
+            0, 0, anchor=NW, window=self.frame, state='hidden',
+            width=table.canvas_width, height=table.row_height)
+        self.date = None
+        self.planned = False
+        self.view = None
+        self.y = self.height = None
+        # текст, выставленный в каждую ячейку
+        self.texts = {}
+
+
+    def set_texts(self, labels, texts):
+        """Выставляет тексты в ячейки, меняя только изменившиеся."""
+        for lb, text in zip(labels, texts):
+            if self.texts.get(lb) != text:
+                lb.config(text=text)
+                self.texts[lb] = text
+
+
+    def set_view(self, view):
+        """Раскладывает нижние строки под вид 'together' или 'once'."""
+        if view == self.view:
+            return
+        if view == 'together':
+            for lb in self.once:
+                lb.grid_remove()
+            self.heads[-1].grid_remove()
+            for lb in self.together:
+                lb.grid()
+        else:
+            for lb in self.together:
+                lb.grid_remove()
+            for lb in self.once:
+                lb.grid()
+            self.heads[-1].grid()
+        self.view = view
+
+
+class _RowLayout:
+    """Высоты строк таблицы и их положение (дерево Фенвика).
+
+    Высота строки меняется, а верх любой строки и строка под
+    координатой находятся за O(log n) - без сдвига остальных строк.
+
+    >>> layout = _RowLayout()
+    >>> for height in (19, 19, 76, 19):
+    ...     layout.append(height)
+    >>> layout.offset(3), layout.find(60), layout.total
+    (114, 2, 133)
+    >>> layout.set(2, 19)
+    >>> layout.offset(3), layout.find(60), layout.total
+    (57, 3, 76)
+    >>> layout.truncate(1)
+    >>> len(layout), layout.total, layout.find(100)
+    (1, 19, 0)
+    """
+
+    def __init__(self):
+        self.heights = []
+        self.total = 0
+        # _tree[j] - сумма высот строк j - lowbit(j) .. j - 1
+        self._tree = [0]
+
+
+    def __len__(self):
+        return len(self.heights)
+
+
+    def append(self, height):
+        """Добавляет строку в конец."""
+        n = len(self._tree)
+        value = height
+        j = n - 1
+        while j > n - (n & -n):
+            value += self._tree[j]
+            j -= j & -j
+        self._tree.append(value)
+        self.heights.append(height)
+        self.total += height
+
+
+    def find(self, y):
+        """Номер строки, в которую попадает координата y."""
+        n = len(self.heights)
+        i = 0
+        step = 1 << n.bit_length()
+        while step:
+            if i + step <= n and self._tree[i + step] <= y:
+                i += step
+                y -= self._tree[i]
+            step >>= 1
+        return max(0, min(i, n - 1))
+
+
+    def visible(self, top, height):
+        """Номера строк, видных в окне высотой height с верхом top.
+
+        Строк в окне не больше, чем height // (самая низкая строка) + 2
+        (первая и последняя могут быть видны частично), сколько бы их ни
+        было всего и как бы ни прокрутили таблицу - столько строк и в
+        пуле PaymentTable (см. PaymentTable.__redraw):
+
+        >>> layout = _RowLayout()
+        >>> for i in range(600):
+        ...     layout.append(76 if i % 3 else 19)
+        >>> max(len(layout.visible(top, 280))
+        ...     for top in range(-19, layout.total)) <= 280 // 19 + 2
+        True
+        >>> layout.truncate(0)
+        >>> for i in range(600):
+        ...     layout.append(19)
+        >>> max(len(layout.visible(top, 280))
+        ...     for top in range(-19, layout.total)) <= 280 // 19 + 2
+        True
+        >>> layout.truncate(0)
+        >>> layout.visible(0, 280)
+        range(0, 0)
+        """
+        return range(self.find(top),
+                     min(len(self.heights), self.find(top + height) + 1))
+
+
+    def offset(self, i):
+        """Верх строки i (сумма высот строк до неё)."""
+        offset = 0
+        while i > 0:
+            offset += self._tree[i]
+            i -= i & -i
+        return offset
+
+
+    def set(self, i, height):
+        """Меняет высоту строки i."""
+        delta = height - self.heights[i]
+        if not delta:
+            return
+        self.heights[i] = height
+        self.total += delta
+        j = i + 1
+        while j < len(self._tree):
+            self._tree[j] += delta
+            j += j & -j
+
+
+    def truncate(self, n):
+        """Оставляет первые n строк."""
+        self.total -= sum(self.heights[n:])
+        del self.heights[n:]
+        del self._tree[n + 1:]
+
+
 class PaymentTable(Frame):
-    """Класс для создания таблицы платежей"""
+    """Класс для создания таблицы платежей
+
+    Таблица виртуальная: виджеты есть только у строк, которые видны
+    в окне (пул _TableRow), при прокрутке они показывают другие
+    платежи. Для каждого платежа хранятся только дата, галка
+    (expend_rowVars), признак планирования и положение строки.
+    """
 
     def __init__(self, parent, names=None, *arg, **kw):
         """Таблица платежей."""
@@ -596,14 +963,20 @@ class PaymentTable(Frame):
         self.__names = names
         self.indicate_allVar = IntVar()
         self.view = 'together'
-        self.changing_cells = collections.defaultdict(list)
-        self.expend_rowVars = collections.defaultdict(IntVar)
+        self.expend_rowVars = collections.defaultdict(_RowVar)
         self.row_height = 19
 
-        self.row_count = 0
         self.last_date = None
         self.first_date = None
 
+        self.__calc = None
+        self.__dates = []       # даты строк по порядку
+        self.__planned = []     # строки, добавленные при планировании
+        # высоты строк (под шапкой таблицы)
+        self.__layout = _RowLayout()
+        self.__bound = {}       # номер строки -> _TableRow
+        self.__free = []        # свободные _TableRow
+
         # first head
         headFr = Frame(self.canvas)
         dateCh = Checkbutton(
@@ -629,76 +1002,51 @@ class PaymentTable(Frame):
         self.scr["command"] = self.canvas.yview
 
         self.canvas.config(
-            yscrollcommand=self.scr.set,
+            yscrollcommand=self.__scrolled,
             scrollregion=(0, 0, 650, self.row_height))
 
-        self.canvas.create_text(312 if not sys.platform == 'win32' else 240,
-                                140, tags='init_text',
-                                font=('New Roman', 12),
-                                text=('Здесь будет таблица с'
-                                      'информацией о Ваших '
-                                      'платежах\n(после добавления платежа)'),
-                                justify=CENTER)
+        self.__init_text()
 #        self.bind_all("<MouseWheel>", func=self.__rollWheel)
         self.bind_all("<Button-4>", func=self.__rollWheel)
         self.bind_all("<Button-5>", func=self.__rollWheel)
 
 
     def expand_row(self, date):
-        """Метод разворачивает строку с соответствующей датой."""
-        if self.expend_rowVars[date].get():
-            # сдвинули область скрола
-            self.canvas.config(
-                scrollregion=(
-                    0, 0, self.canvas_width,
-                    int(float(self.canvas['scrollregion'].split(' ')[3])) + \
-                    self.row_height*(len(self.__names)+1)
-                    )
-                )
-            # разварачиваем строку
-            if date != self.last_date:
-                x, y = self.canvas.coords(
-                    str(date_plus_months(date, 1, initdate=self.first_date)))
-                self.canvas.addtag_overlapping(
-                    'move', int(x), int(y),
-                    *[int(float(i)) for i in \
-                      self.canvas['scrollregion'].split(' ')[2:4]]
-                    )
-                self.canvas.move(
-                    'move', 0, self.row_height*(len(self.__names)+1))
-                self.canvas.dtag('move')
-            self.canvas.itemconfig(
-                str(date), height=self.row_height*(len(self.__names)+2))
-        else:
-            if date != self.last_date:
-                x, y = self.canvas.coords(
-                    str(date_plus_months(date, 1, initdate=self.first_date)))
-                self.canvas.addtag_overlapping(
-                    'move', int(x), int(y),
-                    *[int(float(i)) for i in \
-                      self.canvas['scrollregion'].split(' ')[2:4]])
-                self.canvas.move(
-                    'move', 0, -self.row_height*(len(self.__names)+1))
-                self.canvas.dtag('move')
-            self.canvas.itemconfig(str(date), height=self.row_height)
-            self.canvas.config(
-                scrollregion=(
-                    0, 0, self.canvas_width,
-                    int(float(self.canvas['scrollregion'].split(' ')[3]) - \
-                        self.row_height*(len(self.__names)+1))
-                    )
-                )
-
-
-    def new_payments(self, calc, planning_mode=False):
-        """Отображает информацию о новых платежах, как новые строки"""
+        """Метод разворачивает строку с соответствующей датой.
+
+        Развернута строка или нет - по галке expend_rowVars[date].
+        """
+        self.__resize(date)
+        self.__set_scrollregion()
+        self.__redraw()
+
+
+    def new_payments(self, calc, planning_mode=False, limit=None):
+        """Отображает информацию о новых платежах, как новые строки
+
+        Если задан limit - добавляется не больше limit строк (чтобы
+        длинная история выводилась частями, см. MainWindow.fileLoad).
+        Возвращает число ещё не выведенных платежей.
+        """
         if self.first_date is None:
             self.first_date = calc['together'].first_date
-        for date, info in sorted(calc['together'].data.items()):
-            if self.last_date is not None and self.last_date >= date:
-                continue
-            self.__create_row(date, info, planning_mode=planning_mode)
-            self.__view_together_or_once(date, calc, view=self.view)
+        self.__calc = calc
+        data = calc['together'].data
+        # строки уже есть для всех платежей до last_date включительно
+        start = 0 if self.last_date is None else \
+                data.position(self.last_date + datetime.timedelta(days=1))
+        stop = len(data) if limit is None else min(len(data), start + limit)
+        if start < stop and self.last_date is None:
+            self.canvas.delete('init_text')
+        for ordinal in data.column('date', start, stop):
+            date = datetime.date.fromordinal(ordinal)
+            self.__dates.append(date)
+            self.__planned.append(planning_mode)
+            self.__layout.append(self.__height(date))
+            self.last_date = date
+        self.__set_scrollregion()
+        self.__redraw()
+        return len(data) - stop
 
 
     def remove_row(self, date):
@@ -707,167 +1055,210 @@ class PaymentTable(Frame):
             assert date <= self.last_date, 'Нет такой даты'
         else:
             return
-        x, y = self.canvas.coords(str(date))
-        self.canvas.addtag_overlapping(
-            'delete', int(x), int(y),
-            *[int(float(i)) for i in \
-              self.canvas['scrollregion'].split(' ')[2:4]]
-            )
-        self.canvas.delete('delete')
-        self.canvas.dtag('delete')
-        self.canvas.config(
-            scrollregion=(0, 0, self.canvas_width, int(y)))
-
-        for d in sorted(self.expend_rowVars.keys(), reverse=True):
-            if d < date:
-                break
-            del self.expend_rowVars[d]
-            del self.changing_cells[d]
-
-        self.last_date = date_plus_months(date, -1, initdate=self.first_date) \
-                         if not len(self.expend_rowVars) == 0 else None
+        i = bisect.bisect_left(self.__dates, date)
+        for d in self.__dates[i:]:
+            self.expend_rowVars.pop(d, None)
+        del self.__dates[i:]
+        del self.__planned[i:]
+        self.__layout.truncate(i)
+        for j in [j for j in self.__bound if j >= i]:
+            self.__release(j)
+        self.__set_scrollregion()
+
+        self.last_date = self.__dates[-1] if self.__dates else None
         if self.last_date is None:
             self.first_date = None
-            self.canvas.create_text(
-                312 if not sys.platform == 'win32' else 240,
-                180 if sys.platform == 'win32' else 140, tags='init_text',
-                font=('New Roman', 12),
-                text=('Здесь будет таблица с информацией о Ваших платежах\n'
-                      '(после добавления платежа)'),
-                justify=CENTER)
+            self.__calc = None
+            self.__init_text()
+        self.__redraw()
+
+
+    def update_rows(self, calc, modified=None, removed=None,
+                    planning_mode=False):
+        """Вносит в таблицу изменения истории, не перестраивая её.
+
+        modified - (первая, последняя) даты пересчитанных платежей:
+        из них перерисовываются только видимые строки, и в них
+        меняются только ячейки с новым текстом; галки и развёрнутость
+        строк сохраняются. removed - дата, начиная с которой платежи
+        удалены (или None). Новые платежи после последней строки
+        добавляются, как в new_payments.
+        """
+        if removed is not None and self.last_date is not None and \
+           removed <= self.last_date:
+            self.remove_row(removed)
+        self.__calc = calc
+        if modified is not None:
+            first, last = modified
+            for i, row in self.__bound.items():
+                if first <= row.date <= last:
+                    self.__bind(row, i)
+        self.new_payments(calc, planning_mode=planning_mode)
 
 
     def set_names(self, names):
         """Устанавливает имена"""
         self.__names = names
+        # у строк пула нижние строки - под прежних плательщиков
+        for i in list(self.__bound):
+            self.__release(i)
+        for row in self.__free:
+            self.canvas.delete(row.item)
+            row.frame.destroy()
+        self.__free = []
+        self.__redraw()
 
 
     def view_extra_row(self, calc, view):
         """Меняет вид всех развернутых строк.
 
         Вид может быть: для всех вместе или для
-        кажного плательщика в отдельности.
+        кажного плательщика в отдельности. Перерисовываются
+        только видимые строки, остальные получат вид при прокрутке.
         """
-        for date in calc['together'].data.keys():
-            self.__view_together_or_once(date, calc, view)
+        self.__calc = calc
         self.view = view
+        for i, row in self.__bound.items():
+            self.__bind(row, i)
 
 
-    def __view_together_or_once(self, date, calc, view='together'):
-        """Меняет вид конкретной развернутой строки"""
+    def widget_count(self):
+        """Число виджетов в таблице.
 
-        def break_list(lst, n):
-            """Разбивает список на списки с заданным кол-вом элементов
+        Не зависит ни от длины истории, ни от числа переключений вида:
+        строк в пуле не больше, чем помещается в окне (см. __redraw),
+        а вид переключается в уже созданных ячейках (в настоящем Tk это
+        проверяет _PaymentTableTest).
+        """
+        count = 0
+        widgets = [self]
+        while widgets:
+            children = widgets.pop().winfo_children()
+            count += len(children)
+            widgets.extend(children)
+        return count
+
+
+    def __bind(self, row, i):
+        """Показывает в строке пула row платёж номер i."""
+        date = self.__dates[i]
+        calc = self.__calc
+        info = calc['together'].data[date]
+        row.date = date
+        planned = self.__planned[i]
+        if planned != row.planned:
+            bg = 'cornsilk' if not planned else 'pale green'
+            row.check.config(bg=bg)
+            for lb in row.cells:
+                lb.config(bg=bg)
+            row.planned = planned
+        row.set_texts(row.cells,
+                      ("{0}".format(i + 1),
+                       "{0}".format(str(date)),
+                       "{0}".format(info.loan_payment),
+                       "{0}".format(info.bank_interest),
+                       "{0}".format(info.annuity),
+                       "{0}".format(round(info.loan_sum))))
+        row.set_texts(row.payments,
+                      ['{0}'.format(payment) for payment in info.payment])
+        row.set_view(self.view)
+        if self.view == 'together':
+            row.set_texts(row.together,
+                          ('{0}'.format(round(info.overpayment, 2)),
+                           '{0}'.format(round(info.profit_bp, 2))))
+        else:
+            texts = []
+            for name in self.__names:
+                info = calc[name].data[date]
+                texts.extend(('{0}'.format(round(info.overpayment, 2)),
+                              '{0}'.format(round(info.profit_bp, 2)),
+                              '{0}'.format(round(info.loan_sum))))
+            row.set_texts(row.once, texts)
+        self.__place(row, i)
 
-            Если кол-во эл-тов не кратны заданному числу,
-            в последнем списке будет меньше значений).
-            """
-            i = 0
-            j = n
-            while True:
-                br_l = lst[i:j]
-                if br_l:
-                    yield lst[i:j]
-                    i = j
-                    j += n
-                else:
-                    break
 
-        if self.last_date is None: return
+    def __height(self, date):
+        """Высота строки с датой date (развернутой или нет)."""
+        if self.expend_rowVars[date].get():
+            return self.row_height*(len(self.__names)+2)
+        return self.row_height
 
-        if view == 'together':
-            info = calc['together'].data[date]
-            for lb in self.changing_cells[date][2:]:
-                # удаляем нижние строки
-                lb.grid_remove()
-            for i, (lb, text) in enumerate(
-                zip(self.changing_cells[date][:2],
-                    ('{0}'.format(round(info.overpayment, 2)),
-                     '{0}'.format(round(info.profit_bp, 2)))),
-                start=4):
-                lb.config(text=text)
-                lb.grid(row=2, column=i, rowspan=len(self.__names), sticky=NSEW)
-            # в более старших версиях (>3.1) возвращается список, а не map
-            list(lb.master.grid_slaves(column=6, row=1))[0].grid_remove()
-        elif view == 'once':
-            for lb in self.changing_cells[date][:2]:
-                lb.grid_forget()
-            for row, (name, payer_row) in enumerate(
-                zip(self.__names, break_list(self.changing_cells[date], 3)),
-                start=2):
-                info = calc[name].data[date]
-                for i, (lb, text) in enumerate(
-                    zip(payer_row,
-                        ('{0}'.format(round(info.overpayment, 2)),
-                         '{0}'.format(round(info.profit_bp, 2)),
-                         '{0}'.format(round(info.loan_sum)))),
-                    start=4):
-                    lb.config(text=text)
-                    lb.grid(row=row, column=i, sticky=NSEW)
-            Label(lb.master, text='Долг:', relief=GROOVE,
-                  justify=LEFT, bg='moccasin').grid(
-                      row=1, column=6, padx=0, pady=0, sticky=EW)
-
-
-    def __create_row(self, date, info, planning_mode):
-        """Метод создает строку в таблице"""
 
-        if self.last_date is None:
-            self.canvas.delete('init_text')
-        rowFr = Frame(self.canvas, bg='khaki')
-        dateCh = Checkbutton(
-            rowFr, text='', variable=self.expend_rowVars[date], width=1,
-            height=1, bg='cornsilk' if not planning_mode else 'pale green',
-            onvalue=1, offvalue=0,
-            command=functools.partial(self.expand_row, date=date))
-        dateCh.grid(row=0, column=0, padx=0, pady=0, sticky=EW)
-        for i, (text, width) in enumerate(
-            zip(("{0}".format(len(self.expend_rowVars)),
-                 "{0}".format(str(date)),
-                 "{0}".format(info.loan_payment),
-                 "{0}".format(info.bank_interest),
-                 "{0}".format(info.annuity),
-                 "{0}".format(round(info.loan_sum))),
-                (6, 16, 11, 13, 11, 14))):
-            lb = Label(
-                rowFr, width=width, text=text, relief=GROOVE, justify=LEFT,
-                bg='cornsilk' if not planning_mode else 'pale green')
-            lb.grid(row=0, column=i+1, padx=0, pady=0, sticky=EW)
+    def __init_text(self):
+        """Подсказка в пустой таблице."""
+        self.canvas.create_text(
+            312 if not sys.platform == 'win32' else 240,
+            180 if sys.platform == 'win32' else 140, tags='init_text',
+            font=('New Roman', 12),
+            text=('Здесь будет таблица с информацией о Ваших платежах\n'
+                  '(после добавления платежа)'),
+            justify=CENTER)
 
-        # extra info head
-        for k, text in enumerate(
-            ('Плательщик:', "Платеж:", "Переплата:", "Экономия:", 'Долг:')):
-            slb = Label(rowFr, text=text, relief=GROOVE,
-                        justify=LEFT, bg='moccasin')
-            slb.grid(row=1, column=2+k, padx=0, pady=0, sticky=EW)
 
-        # imitation extra info
-        for k, name in enumerate(self.__names):
-            Label(rowFr, text=name, relief=GROOVE,
-                  justify=LEFT, bg='white', height=1).grid(
-                      row=2+k, column=2, padx=0, pady=0, sticky=EW)
-            for column, text in enumerate(
-                ('{0}'.format(info.payment[k]),
-                 '{0}'.format(info.overpayment),
-                 '{0}'.format(info.profit_bp),
-                 '{0}'.format(round(info.loan_sum))),
-                start=3):
-                lb = Label(rowFr, text=text, relief=GROOVE,
-                           justify=LEFT, bg='white')
-                lb.grid(row=2+k, column=column, padx=0, pady=0, sticky=EW)
-                # запоминаем строки, которые затем надо будет изменять
-                if column > 3:
-                    self.changing_cells[date].append(lb)
-
-        self.canvas.create_window(
-            0, int(float(self.canvas['scrollregion'].split(' ')[3])),
-            tag=str(date), anchor=NW, window=rowFr,
-            width=self.canvas_width, height=self.row_height)
-
-        x, y = self.canvas.coords(str(date))
-        self.canvas.config(
-            scrollregion=(0, 0, self.canvas_width, int(y+self.row_height)))
-        self.last_date = date
+    def __place(self, row, i):
+        """Ставит строку пула на место строки i (высота, галка)."""
+        y = self.row_height + self.__layout.offset(i)
+        height = self.__layout.heights[i]
+        if (y, height) != (row.y, row.height):
+            self.canvas.coords(row.item, 0, y)
+            self.canvas.itemconfigure(row.item, height=height,
+                                      state='normal')
+            row.y, row.height = y, height
+        checked = self.expend_rowVars[row.date].get()
+        if row.var.get() != checked:
+            row.var.set(checked)
+
+
+    def __redraw(self):
+        """Раздаёт строки пула платежам, которые видны в окне."""
+        rows = self.__layout.visible(
+            self.canvas.canvasy(0) - self.row_height, self.canvas_height)
+        for i in [i for i in self.__bound if i not in rows]:
+            self.__release(i)
+        for i in rows:
+            row = self.__bound.get(i)
+            if row is None:
+                row = self.__free.pop() if self.__free else \
+                      _TableRow(self, self.__names, self.__toggle)
+                self.__bound[i] = row
+                self.__bind(row, i)
+            else:
+                self.__place(row, i)
+
+
+    def __release(self, i):
+        """Возвращает в пул строку, показывавшую платёж номер i."""
+        row = self.__bound.pop(i)
+        self.canvas.itemconfigure(row.item, state='hidden')
+        row.date = row.y = row.height = None
+        self.__free.append(row)
+
+
+    def __scrolled(self, *args):
+        """Окно прокрутили: сдвигаем полосу и перерисовываем строки."""
+        self.scr.set(*args)
+        self.__redraw()
+
+
+    def __set_scrollregion(self):
+        """Область прокрутки - до низа последней строки."""
+        self.canvas.config(scrollregion=(
+            0, 0, self.canvas_width if self.__dates else 650,
+            self.row_height + self.__layout.total))
+
+
+    def __resize(self, date):
+        """Высота строки с датой date - по её галке."""
+        i = bisect.bisect_left(self.__dates, date)
+        assert i < len(self.__dates) and self.__dates[i] == date, \
+               'Нет такой даты'
+        self.__layout.set(i, self.__height(date))
+
+
+    def __toggle(self, row):
+        """Щёлкнули по галке строки пула."""
+        self.expend_rowVars[row.date].set(row.var.get())
+        self.expand_row(row.date)
 
 
     def __indicate_all(self, *ign):
@@ -876,15 +1267,15 @@ class PaymentTable(Frame):
         if self.last_date is None:
             return
 
-        for date, var in sorted(self.expend_rowVars.items()):
-            if self.indicate_allVar.get():
-                if var.get() == 0:
-                    var.set(1)
-                    self.expand_row(date)
-            else:
-                if var.get() == 1:
-                    var.set(0)
-                    self.expand_row(date)
+        # меняются высоты только переключённых строк, а область
+        # прокрутки и видимые строки обновляются один раз
+        checked = self.indicate_allVar.get()
+        for date, var in self.expend_rowVars.items():
+            if var.get() != checked:
+                var.set(checked)
+                self.__resize(date)
+        self.__set_scrollregion()
+        self.__redraw()
 
 
     def __rollWheel(self, event):
@@ -937,9 +1328,8 @@ class Display(Frame):
         self.canvas.delete('delete_text')
 
         remaining_debt = 1 - calc.loan_sum / calc.first_loan_sum
-        probable_remaining_debt = sum(
-            info.loan_payment for info in calc.data.values()
-            ) / calc.first_loan_sum
+        probable_remaining_debt = calc.totals().loan_payment / \
+                                  calc.first_loan_sum
 
         self.canvas.create_oval(5, 5, 175, 175, fill='cornsilk', tag='delete')
         if remaining_debt < 1:
@@ -973,9 +1363,9 @@ class Display(Frame):
             self.canvas.delete('delete_text')
             pl_remaining_debt = 1 - planning_calc.loan_sum / \
                                 planning_calc.first_loan_sum
-            pl_probable_remaining_debt = sum(
-                info.loan_payment for info in planning_calc.data.values()
-                ) / planning_calc.first_loan_sum
+            pl_probable_remaining_debt = \
+                planning_calc.totals().loan_payment / \
+                planning_calc.first_loan_sum
             self.canvas.create_arc(
                 5, 5, 175, 175,
                 extent=int(-360*(pl_remaining_debt - remaining_debt)),
@@ -1013,3 +1403,46 @@ class Display(Frame):
                                start=-30, tag='delete', width=3)
         self.canvas.create_line(60, 40, 60, 100, tag='delete', width=3)
         self.canvas.create_line(120, 40, 120, 100, tag='delete', width=3)
+
+
+class _PaymentTableTest(unittest.TestCase):
+    """Таблица платежей в настоящем Tk: python3 -m unittest MyWidgets.
+
+    Без дисплея проверка пропускается (и так и помечается), а не
+    засчитывается.
+    """
+
+    @unittest.skipUnless(sys.platform in ('win32', 'darwin') or
+                         os.environ.get('DISPLAY'), 'нет дисплея')
+    def test_widget_count(self):
+        """Виджеты и объекты Tcl не растут при переключении вида."""
+        from Calculation import Calculation, Storage
+        root = Tk()
+        self.addCleanup(root.destroy)
+        first = datetime.date(2013, 7, 3)
+        calc = {'together': Calculation(first, 900000, 14.5, 120),
+                'a': Calculation(first, 450000, 14.5, 120),
+                'b': Calculation(first, 450000, 14.5, 120)}
+        calc['together'].new_payment(
+            {date_plus_months(first, i): Storage((15000, 10000), False)
+             for i in range(1, 61)},
+            payers=[calc['a'], calc['b']])
+        table = PaymentTable(root, names=['a', 'b'])
+        table.new_payments(calc)
+        for date in calc['together'].data:
+            table.expend_rowVars[date].set(1)
+            table.expand_row(date)
+        sizes = set()
+        for i in range(200):
+            table.view_extra_row(calc, ('once', 'together')[i%2])
+            root.update_idletasks()
+            sizes.add((table.widget_count(),
+                       len(root.tk.call('info', 'commands')),
+                       len(root.tk.call('info', 'vars'))))
+        self.assertEqual(len(sizes), 1, sizes)
+
+
+def load_tests(loader, tests, ignore):
+    """python3 -m unittest MyWidgets запускает и доктесты модуля."""
+    tests.addTests(doctest.DocTestSuite(sys.modules[__name__]))
+    return tests
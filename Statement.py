@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# This program or module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version. It is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""Импорт истории платежей из банковской выписки (CSV).
+
+Выписка - таблица с заголовком: дата платежа, по столбцу на каждого
+плательщика (по имени; если плательщик один - можно столбец payment)
+и, по желанию, флаг пересчёта:
+
+    date;Иван;Мария;recalc
+    03.08.2013;65000;0;да
+    03.09.2013;18 000,50;;нет
+
+Разделитель (; , или табуляция) определяется по заголовку, дата -
+ДД.ММ.ГГГГ или ГГГГ-ММ-ДД, в суммах допускаются пробелы и запятая.
+Строки читаются и проверяются по одной (check_statement), все ошибки
+собираются вместе, а платежи вносятся в историю одним new_payment.
+"""
+
+__all__ = ['Row', 'check_statement', 'read_statement']
+
+import collections
+import csv
+import datetime
+import itertools
+
+from Calculation import Storage
+from MyDateLib import date_plus_months
+
+
+# Строка выписки: номер строки файла, дата, кортеж платежей плательщиков,
+# флаг пересчёта и текст ошибки (если строку не удалось разобрать)
+Row = collections.namedtuple('Row', 'line date payment recalc error')
+
+DATE_COLUMNS = ('date', 'дата')
+RECALC_COLUMNS = ('recalc', 'пересчёт', 'пересчет')
+PAYMENT_COLUMNS = ('payment', 'платеж', 'платёж', 'сумма')
+
+
+def read_statement(stream, names):
+    """Читает строки выписки из потока (генератор Row).
+
+    names - имена плательщиков (столбцы платежей). Ошибки разбора
+    не прерывают чтение: строка возвращается с текстом ошибки.
+    """
+    first = stream.readline()
+    if not first.strip():
+        yield Row(1, None, None, None, 'выписка пуста')
+        return
+    try:
+        dialect = csv.Sniffer().sniff(first, ';,\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(itertools.chain([first], stream), dialect)
+    header = [name.strip().lower() for name in next(reader)]
+
+    def column(variants):
+        for variant in variants:
+            if variant.lower() in header:
+                return header.index(variant.lower())
+        return None
+
+    date_column = column(DATE_COLUMNS)
+    recalc_column = column(RECALC_COLUMNS)
+    payers = [column([name]) for name in names]
+    if len(names) == 1 and payers[0] is None:
+        payers = [column(PAYMENT_COLUMNS)]
+    missing = [name for name, index in zip(names, payers) if index is None]
+    if date_column is None or missing:
+        yield Row(1, None, None, None, 'нет столбцов: {0}'.format(
+            ', '.join((['date'] if date_column is None else []) + missing)))
+        return
+
+    for line, record in enumerate(reader, start=2):
+        if not any(value.strip() for value in record):
+            continue
+        record = record + [''] * (len(header) - len(record))
+        try:
+            date = _date(record[date_column])
+            payment = tuple(_amount(record[index]) for index in payers)
+            recalc = _flag(record[recalc_column]) \
+                     if recalc_column is not None else False
+        except ValueError as err:
+            yield Row(line, None, None, None, str(err))
+        else:
+            yield Row(line, date, payment, recalc, None)
+
+
+def check_statement(calc, rows):
+    """Проверяет строки выписки по расчёту calc за один проход.
+
+    Каждая строка сразу считается в копии расчёта (Calculation.snapshot),
+    поэтому следующая проверяется уже с учётом предыдущих; сам calc не
+    меняется. Проверки те же, что в окне добавления платежей: платежи
+    подряд, месяц за месяцем, платеж (с остатком прошлого месяца) не
+    меньше аннуитетного и не больше задолженности. После первой ошибки
+    в сумме или строки, которую не удалось разобрать, расчёт уже
+    неверен, поэтому у следующих строк проверяются только даты и знак
+    платежей - без ложных ошибок в суммах (неразобранная строка
+    занимает свой месяц).
+    Возвращает ({дата: Storage(payment, recalc)}, [ошибки]); платежи
+    вносятся в историю одним calc.new_payment, если ошибок нет.
+
+    >>> import datetime
+    >>> from Calculation import Calculation
+    >>> calc = Calculation(datetime.date(2013, 7, 3), 900000, 14.5, 120)
+    >>> rows = [Row(line, datetime.date(2013, month, 3), (payment,),
+    ...             False, None) for line, month, payment in
+    ...         [(2, 8, 15000), (3, 9, 100), (4, 10, 15000), (5, 12, 15000)]]
+    >>> payments, errors = check_statement(calc, rows)
+    >>> for error in errors:
+    ...     print(error)
+    строка 3: платеж 100 меньше ежемесячного (14245.81, с остатком 754.19)
+    строка 5: дата 2013-12-03, а следующий платеж - 2013-11-03
+    >>> sorted(payments) == [datetime.date(2013, 8, 3),
+    ...                      datetime.date(2013, 9, 3)]
+    True
+
+    Строка, которую не удалось разобрать, и повтор даты:
+
+    >>> import io
+    >>> rows = read_statement(io.StringIO(
+    ...     'date;payment\\n03.08.2013;15000\\n03.09.2013;15x000\\n'
+    ...     '03.10.2013;15000\\n03.11.2013;15000\\n03.11.2013;15000\\n'
+    ...     '03.12.2013;-1\\n'), ['Иван'])
+    >>> payments, errors = check_statement(calc, rows)
+    >>> for error in errors:
+    ...     print(error)
+    строка 3: неверная сумма '15x000'
+    строка 6: дата 2013-11-03, а следующий платеж - 2013-12-03
+    строка 7: отрицательный платеж
+    >>> sorted(payments) == [datetime.date(2013, 8, 3)]
+    True
+    >>> payments, errors = check_statement(calc, read_statement(
+    ...     io.StringIO('date;payment\\n03.08.2013;15000\\n'
+    ...                 '03.08.2013;20000\\n'), ['Иван']))
+    >>> errors
+    ['строка 3: дата 2013-08-03, а следующий платеж - 2013-09-03']
+    >>> payments[datetime.date(2013, 8, 3)].payment
+    (15000.0,)
+    """
+    calculation = calc.snapshot()
+    payments = {}
+    errors = []
+    date = None     # дата строки после остановки расчёта
+    for row in rows:
+        if row.error:
+            errors.append('строка {0}: {1}'.format(row.line, row.error))
+            # строка занимает свой месяц, дальше - только порядок дат
+            date = date_plus_months(
+                calculation.date if date is None else date, 1,
+                initdate=calculation.first_date)
+            continue
+        if date is None:
+            error, calculated = _check_row(calculation, row)
+            if calculated:
+                payments[row.date] = Storage(row.payment, row.recalc)
+                if error:
+                    date = row.date
+        else:
+            error = _check_order(date, calculation.first_date, row)
+            if error is None:
+                date = row.date
+        if error:
+            errors.append('строка {0}: {1}'.format(row.line, error))
+    return payments, errors
+
+
+def _check_row(calculation, row):
+    """Считает строку в calculation: (текст ошибки или None, посчитана ли).
+
+    Строка с неверной датой не считается, с неверной суммой - считается,
+    чтобы проверка следующих строк шла по порядку.
+    """
+    if round(calculation.loan_sum, 2) <= 0:
+        return 'кредит уже закрыт', False
+    error = _check_order(calculation.date, calculation.first_date, row)
+    if error:
+        return error, False
+    loan = calculation.loan_sum
+    annuity = calculation.actualy_annuity
+    the_rest = calculation.data.last()[1].the_rest if calculation.data \
+               else 0
+    total = sum(row.payment)
+    calculation.new_payment({row.date: Storage(row.payment, row.recalc)})
+    debt = round(loan + calculation.data[row.date].bank_interest, 2)
+    if total + the_rest < annuity and total < debt:
+        return 'платеж {0} меньше ежемесячного ({1}{2})'.format(
+            total, annuity,
+            ', с остатком {0}'.format(the_rest) if the_rest else ''), True
+    if total + the_rest > debt:
+        return 'платеж {0} больше оставшейся задолженности ({1})'.format(
+            total, debt), True
+    return None, True
+
+
+def _check_order(date, first_date, row):
+    """Ошибка в дате (не следующий после date месяц) или знаке платежа
+    строки; None, если их нет."""
+    expected = date_plus_months(date, 1, initdate=first_date)
+    if row.date != expected:
+        return 'дата {0}, а следующий платеж - {1}'.format(row.date,
+                                                           expected)
+    if any(payment < 0 for payment in row.payment):
+        return 'отрицательный платеж'
+    return None
+
+
+def _amount(text):
+    """Сумма из выписки: '18 000,50' -> 18000.5, пусто - 0.
+
+    >>> _amount('18 000,50'), _amount(''), _amount('65000')
+    (18000.5, 0.0, 65000.0)
+    """
+    text = text.strip().replace('\xa0', '').replace(' ', '').replace(',', '.')
+    if not text:
+        return 0.0
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError('неверная сумма {0!r}'.format(text))
+
+
+def _date(text):
+    """Дата ДД.ММ.ГГГГ или ГГГГ-ММ-ДД."""
+    for format_ in ('%d.%m.%Y', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text.strip(), format_).date()
+        except ValueError:
+            pass
+    raise ValueError('неверная дата {0!r}'.format(text))
+
+
+def _flag(text):
+    """Флаг пересчёта: да/нет, 1/0, true/false."""
+    return text.strip().lower() in ('1', 'true', 'yes', 'да', '+')
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# This program or module is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version. It is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""Рабочая область: много ипотечных историй в одном файле (.mcw).
+
+    MCWORKSP | история 1 | история 2 | ... | индекс (JSON) |
+    смещение индекса (8 байт) | длина индекса (8 байт) | MCWORKSP
+
+История - текст журнала (см. Journal.dumps), индекс - список кредитов
+с условиями, плательщиками, датой последнего платежа, остатком долга,
+итогами и местом истории в файле. Открытие и список кредитов читают
+только индекс (с конца файла), история читается и считается только
+для выбранного кредита (Workspace.load).
+
+Изменения дописываются в конец файла: новая версия истории и новый
+индекс, старые версии остаются в файле мёртвым грузом, пока файл
+не будет переписан (compact). Если дописать не удалось (сбой, нет
+места на диске), при открытии берётся предыдущий целый индекс.
+Командная строка:
+
+    python3 Workspace.py family.mcw                  # список кредитов
+    python3 Workspace.py family.mcw --add a.clc b.clc
+"""
+
+__all__ = ['Workspace', 'main']
+
+import argparse
+import json
+import os
+import pickle
+import struct
+import sys
+
+from Columnar import _load_clc
+from Journal import dumps, loads
+
+
+MAGIC = b'MCWORKSP'
+VERSION = 1
+
+_FOOTER = struct.Struct('<QQ8s')
+
+
+class Workspace:
+    """Файл рабочей области. Если файла нет - он создаётся при записи.
+
+    loans - записи индекса (словари) по порядку добавления.
+    """
+
+    # файл переписывается, когда мёртвые версии занимают больше места,
+    # чем живые истории
+    COMPACT_RATIO = 1
+
+    def __init__(self, filename):
+        """Открывает рабочую область.
+
+        Недописанный конец файла пропускается:
+
+        >>> import datetime, tempfile
+        >>> from Calculation import Calculation
+        >>> folder = tempfile.TemporaryDirectory()
+        >>> filename = os.path.join(folder.name, 'family.mcw')
+        >>> calc = {'together': Calculation(
+        ...     datetime.date(2013, 7, 3), 900000, 14.5, 120)}
+        >>> Workspace(filename).save('first', [], calc)
+        >>> Workspace(filename).save('second', [], calc)
+        >>> with open(filename, 'r+b') as fh:
+        ...     ign = fh.truncate(os.path.getsize(filename) - 5)
+        >>> Workspace(filename).names()
+        ['first']
+        >>> workspace = Workspace(filename)
+        >>> workspace.save('third', [], calc)
+        >>> Workspace(filename).names()
+        ['first', 'third']
+        >>> names, calc = workspace.load('first')
+        >>> folder.cleanup()
+        """
+        self.filename = filename
+        self.loans = []
+        self._size = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as fh:
+                if fh.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(
+                        '{0}: это не рабочая область'.format(filename))
+                fh.seek(0, os.SEEK_END)
+                self._size = fh.tell()
+                index = _last_index(fh, self._size)
+            if index is None:
+                raise ValueError('{0}: файл повреждён'.format(filename))
+            if index['version'] > VERSION:
+                raise ValueError('{0}: неизвестная версия {1}'.format(
+                    filename, index['version']))
+            self.loans = index['loans']
+
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+
+    def __len__(self):
+        return len(self.loans)
+
+
+    def names(self):
+        """Имена кредитов."""
+        return [loan['name'] for loan in self.loans]
+
+
+    def load(self, name):
+        """История кредита name: (имена плательщиков, {имя: Calculation})."""
+        loan = self.loans[self._index(name)]
+        with open(self.filename, 'rb') as fh:
+            fh.seek(loan['offset'])
+            return loads(fh.read(loan['length']).decode('utf-8'))
+
+
+    def save(self, name, names, calc):
+        """Записывает (или заменяет) историю кредита name."""
+        blob = dumps(names, calc).encode('utf-8')
+        entry = _entry(name, names, calc)
+        i = self._find(name)
+        if i is None:
+            loans = self.loans + [entry]
+        else:
+            loans = self.loans[:i] + [entry] + self.loans[i + 1:]
+        self._append(loans, [(entry, blob)])
+
+
+    def remove(self, name):
+        """Удаляет кредит name из рабочей области."""
+        i = self._index(name)
+        self._append(self.loans[:i] + self.loans[i + 1:], [])
+
+
+    def compact(self):
+        """Переписывает файл без старых версий историй.
+
+        Пишется во временный файл, который затем заменяет рабочую область.
+        """
+        temp = self.filename + '.tmp'
+        loans = []
+        with open(self.filename, 'rb') as source, open(temp, 'wb') as fh:
+            fh.write(MAGIC)
+            for loan in self.loans:
+                source.seek(loan['offset'])
+                blob = source.read(loan['length'])
+                loans.append(dict(loan, offset=fh.tell()))
+                fh.write(blob)
+            self._size = _write_index(fh, loans)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp, self.filename)
+        self.loans = loans
+
+
+    def _append(self, loans, blobs):
+        """Дописывает истории blobs [(запись индекса, байты)] и индекс."""
+        mode = 'r+b' if os.path.exists(self.filename) else 'w+b'
+        with open(self.filename, mode) as fh:
+            fh.seek(0, os.SEEK_END)
+            if fh.tell() == 0:
+                fh.write(MAGIC)
+            for entry, blob in blobs:
+                entry.update(offset=fh.tell(), length=len(blob))
+                fh.write(blob)
+            self._size = _write_index(fh, loans)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.loans = loans
+        live = sum(loan['length'] for loan in loans)
+        if self._size - live > self.COMPACT_RATIO * live + 4096:
+            self.compact()
+
+
+    def _find(self, name):
+        """Номер кредита name в индексе (или None)."""
+        for i, loan in enumerate(self.loans):
+            if loan['name'] == name:
+                return i
+        return None
+
+
+    def _index(self, name):
+        """Номер кредита name в индексе; KeyError, если его нет."""
+        i = self._find(name)
+        if i is None:
+            raise KeyError(name)
+        return i
+
+
+def main(argv=None):
+    """Точка входа командной строки: список и добавление кредитов."""
+    parser = argparse.ArgumentParser(
+        description='Рабочая область с несколькими ипотечными историями.')
+    parser.add_argument('workspace', help='файл рабочей области (.mcw)')
+    parser.add_argument('--add', nargs='+', metavar='CLC', default=(),
+                        help='добавить истории из файлов .clc '
+                             '(имя кредита - имя файла)')
+    parser.add_argument('--remove', nargs='+', metavar='NAME', default=(),
+                        help='удалить кредиты')
+    args = parser.parse_args(argv)
+    try:
+        workspace = Workspace(args.workspace)
+        for source in args.add:
+            names, calc = _load_clc(source)
+            workspace.save(os.path.splitext(os.path.basename(source))[0],
+                           names, calc)
+        for name in args.remove:
+            workspace.remove(name)
+    except (EnvironmentError, pickle.PickleError, ValueError,
+            KeyError) as err:
+        print('Ошибка: {0}'.format(err), file=sys.stderr)
+        return 1
+    for loan in workspace.loans:
+        print('{name}\t{loan_sum}\t{percent:g}%\t{period} мес.\t'
+              'платежей: {payments}\tпоследний: {last_date}\t'
+              'долг: {balance}'.format(**loan))
+    return 0
+
+
+def _entry(name, names, calc):
+    """Запись индекса для кредита name (без места в файле)."""
+    together = calc['together']
+    totals = together.totals()
+    return {'name': name, 'first_date': str(together.first_date),
+            'loan_sum': together.first_loan_sum,
+            'percent': together.percent * 100,
+            'period': together.first_period, 'payers': list(names),
+            'payments': len(together.data), 'last_date': str(together.date),
+            'balance': together.loan_sum,
+            'annuity': together.actualy_annuity,
+            'loan_payment': totals.loan_payment,
+            'bank_interest': totals.bank_interest,
+            'overpayment': totals.overpayment, 'profit_bp': totals.profit_bp}
+
+
+def _last_index(fh, size):
+    """Последний целый индекс файла размера size (или None).
+
+    Обычно это индекс перед концовкой в самом конце файла. Если
+    последнее дописывание оборвалось, концовки там нет или она
+    указывает не туда - тогда ищется предыдущая концовка (тоже
+    кончается на MAGIC), и файл читается таким, каким был до сбоя.
+    """
+    data = None
+    end = size
+    while end >= len(MAGIC) + _FOOTER.size:
+        fh.seek(end - _FOOTER.size)
+        offset, length, magic = _FOOTER.unpack(fh.read(_FOOTER.size))
+        if magic == MAGIC and len(MAGIC) <= offset and \
+           offset + length + _FOOTER.size == end:
+            fh.seek(offset)
+            try:
+                index = json.loads(fh.read(length).decode('utf-8'))
+            except ValueError:
+                index = None
+            if isinstance(index, dict) and 'loans' in index:
+                return index
+        if data is None:
+            fh.seek(0)
+            data = fh.read(size)
+        end = data.rfind(MAGIC, len(MAGIC), end - 1) + len(MAGIC)
+    return None
+
+
+def _write_index(fh, loans):
+    """Пишет индекс и концовку файла; возвращает размер файла."""
+    index = json.dumps({'version': VERSION, 'loans': loans},
+                       ensure_ascii=False).encode('utf-8')
+    offset = fh.tell()
+    fh.write(index)
+    fh.write(_FOOTER.pack(offset, len(index), MAGIC))
+    return fh.tell()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,6 @@
 
 """Main window of mortgage calculator"""
 
-import copy
 import datetime
 import pickle
 import os
@@ -19,16 +18,24 @@ import tkinter
 import tkinter.filedialog
 import tkinter.messagebox
 
+from Autosave import Autosave
 from Calculation import Calculation, Storage
+from Journal import Journal, is_journal
 from MyDateLib import date_plus_months
-from MyForms import AddEditForm, PayerNames
 from MyWidgets import AdvancedRepayment, IntegerEntry, MySpinBoxDate, \
                       LoanData, PaymentTable, Display
+# диалоги (MyForms) импортируются при первом открытии, а не при запуске
 
 
 class MainWindow:
     """Класс для создания главного окна программы ипотечного калькулятора"""
 
+    # строк таблицы, которые выводятся за один шаг загрузки файла
+    LOAD_ROWS = 24
+    # автосохранение: раз в столько секунд или после стольких изменений
+    AUTOSAVE_INTERVAL = 60
+    AUTOSAVE_CHANGES = 5
+
     def __init__(self, parent):
         """Cоздает главное окно калькулятора"""
         self.parent = parent
@@ -40,7 +47,11 @@ class MainWindow:
         self.__payer_names = None
         self.__loans = None
         self.filename = None
+        self.journal = None
+        self._loading = None
         self.dirty = False
+        self.autosave = Autosave(interval=self.AUTOSAVE_INTERVAL,
+                                 changes=self.AUTOSAVE_CHANGES)
 
         self.parent.title("Ипотечный калькулятор")
 
@@ -52,6 +63,7 @@ class MainWindow:
             ("Новый...", self.fileNew, "Ctrl+N", "<Control-n>"),
             ("Открыть...", self.fileOpen, "Ctrl+O", "<Control-o>"),
             ("Сохранить...", self.fileSave, "Ctrl+S", "<Control-s>"),
+            ("Экспорт графика...", self.fileExport, None, None),
             (None, None, None, None),
             ("Выход...", self.fileQuit, "Ctrl+Q", "<Control-q>")):
             if label is None:
@@ -61,7 +73,8 @@ class MainWindow:
                                      underline=0,
                                      command=command,
                                      accelerator=shortcut_text)
-                self.parent.bind(shortcut, command)
+                if shortcut is not None:
+                    self.parent.bind(shortcut, command)
         self.menubar.add_cascade(label="Файл", menu=fileMenu, underline=0)
 
         self.editMenu = tkinter.Menu(self.menubar, bg='cornsilk')
@@ -70,7 +83,8 @@ class MainWindow:
             ("Удалить...", self.paymentRemove, "Delete", "<Delete>"),
             ("Редактировать...", self.paymentEdit, "Ctrl+E", "<Control-e>"),
             ("Планировать...", self.planningMode, "Ctrl+P", "<Control-p>"),
-            (None, None, None, None)):
+            (None, None, None, None),
+            ("Импорт выписки...", self.paymentImport, "Ctrl+I", "<Control-i>")):
             if label is None:
                 self.editMenu.add_separator()
             else:
@@ -121,6 +135,16 @@ class MainWindow:
             '<FocusOut>',
             lambda *ign: self.count_payersEntry.insert(0, 2) \
             if self.count_payersEntry.get() == '' else None)
+        # расчёт в копейках (Calculation(kopecks=True)): выбирается
+        # до первого платежа и хранится в файле вместе с историей
+        self.kopecksVar = tkinter.BooleanVar(value=False)
+        self.kopecksCheck = tkinter.Checkbutton(
+            self.frame1, text="Расчёт в копейках", variable=self.kopecksVar,
+            bg='light goldenrod', activebackground='light goldenrod',
+            command=lambda: self.advRepWidget.set_changes(
+                calc=self._new_instance_of_Calc()))
+        self.kopecksCheck.grid(row=2, column=0, columnspan=2, padx=0,
+                               pady=0, sticky=tkinter.W)
         self.frame1.grid(row=0, column=0, padx=10, pady=0, sticky=tkinter.W)
 
         self.spinBox_frame = tkinter.Frame(self.parent, bg='light goldenrod')
@@ -177,9 +201,41 @@ class MainWindow:
 
         self.parent.config(bg='light goldenrod')
 
+        if self.autosave.exists():
+            self.parent.after_idle(self.fileRecover)
+
+
+    def fileExport(self, *ignore):
+        """Сохраняет график платежей (история и прогноз) в CSV/JSON Lines."""
+        if not self.calc:
+            tkinter.messagebox.showinfo(
+                'Нет платежей', 'История платежей пуста.', parent=self.parent)
+            return
+        filename = tkinter.filedialog.asksaveasfilename(
+            title='Mortgage Calc - Export Schedule',
+            initialdir='.',
+            filetypes=[("CSV files", "*.csv"), ("JSON Lines", "*.jsonl")],
+            defaultextension=".csv",
+            parent=self.parent)
+        if not filename:
+            return
+        format_ = 'jsonl' if filename.endswith('.jsonl') else 'csv'
+        try:
+            with open(filename, 'w', newline='', encoding='utf-8') as fh:
+                self.calc['together'].export(fh, format_)
+        except EnvironmentError as err:
+            tkinter.messagebox.showwarning(
+                "Mortgage Calculation - Error",
+                "Failed to save {0}:\n{1}".format(filename, err),
+                parent=self.parent)
+
 
     def fileLoad(self, filename):
-        """Загружает ипотечную историю из файла."""
+        """Загружает ипотечную историю из файла.
+
+        Условия кредита и плательщики показываются сразу, а строки
+        таблицы, диаграмма и планировщик - по частям (см. _load_rows).
+        """
         self.filename = filename
 
         # всем датам выставляем галки
@@ -188,12 +244,15 @@ class MainWindow:
         self.paymentRemove()
         self.dirty = False
         try:
-            with open(self.filename, "rb") as fh:
-                self.__payer_names = pickle.load(fh)
-                self.calc = pickle.load(fh)
+            if is_journal(self.filename):
+                self.journal = Journal(self.filename)
+                self.__payer_names, self.calc = self.journal.load()
+            else:
+                # старый формат: имена плательщиков и расчёты в pickle
+                with open(self.filename, "rb") as fh:
+                    self.__payer_names = pickle.load(fh)
+                    self.calc = pickle.load(fh)
 
-            if len(self.__payer_names) > 1:
-                self.menubar.entryconfigure(3, state='normal')
             credit = self.calc['together'].first_loan_sum
             interest = self.calc['together'].percent * 100
             period = self.calc['together'].first_period
@@ -203,17 +262,15 @@ class MainWindow:
             self.ld.configure(state='readonly')
             self.count_payersEntry.configure(state='readonly')
             self.dateSpinBox.configure(state='readonly')
-
-            self.advRepWidget.set_changes(self.calc['together'])
+            self.kopecksVar.set(self.calc['together'].kopecks)
+            self.kopecksCheck.configure(state='disabled')
 
             self.table.set_names(self.__payer_names)
-            self.table.new_payments(self.calc)
-            self.display.new_payments(self.calc['together'])
-            self.parent.title(
-                "Ипотечный калькулятор - {0}".format(
-                    os.path.basename(self.filename)))
-            self.optionsOffOn(delete=True, edit=True, plan=True)
-        except (EnvironmentError, pickle.PickleError) as err:
+            # пока строки выводятся, платежи менять нельзя
+            self.optionsOffOn(add=False, delete=False, edit=False, plan=False)
+            self._load_rows()
+        except (EnvironmentError, pickle.PickleError, ValueError,
+                KeyError) as err:
             tkinter.messagebox.showwarning(
                 "Mortgage Calcaulation - Error",
                 "Failed to load {0}:\n{1}".format(self.filename, err),
@@ -222,21 +279,30 @@ class MainWindow:
 
     def fileNew(self, *ignore):
         """Создает новую форму для новой ипотечной истории."""
+        if self._loading is not None:
+            self.parent.after_cancel(self._loading)
+            self._loading = None
         if self.calc:
+            # очистка окна - не изменение истории (автосохранению не нужна)
             self._remove_payments(
-                date_plus_months(self.calc['together'].first_date, 1))
+                date_plus_months(self.calc['together'].first_date, 1),
+                changed=False)
 
         self.calc = {}
         self.__payer_names = None
         self.__loans = None
         self.filename = None
+        self.journal = None
         self.dirty = False
+        # старая история сохранена или не нужна (см. okayToContinue)
+        self.autosave.discard()
 
         self.parent.title("Ипотечный калькулятор")
 
         self.ld.configure(state='normal')
         self.count_payersEntry.configure(state='normal')
         self.dateSpinBox.configure(state='normal')
+        self.kopecksCheck.configure(state='normal')
 
         self.menubar.entryconfigure(3, state='disabled')
 
@@ -272,14 +338,39 @@ class MainWindow:
             self.fileLoad(filename)
 
 
+    def fileRecover(self):
+        """Предлагает восстановить историю из автосохранения."""
+        reply = tkinter.messagebox.askyesno(
+            "Ипотечный Калькулятор - Автосохранение",
+            "Найдена несохранённая история платежей.\nВосстановить?",
+            parent=self.parent)
+        if not reply:
+            self.autosave.discard()
+            return
+        self.fileLoad(self.autosave.filename)
+        # восстановленная история ещё не сохранена ни в какой файл
+        self.filename = None
+        self.journal = None
+        if self.calc:
+            self._changed()
+
+
     def fileSave(self, *ignore):
-        """Cохраненной ипотечную историю в файл в формате '.clc'."""
+        """Cохраненной ипотечную историю в файл в формате '.clc'.
+
+        Файл - журнал (см. модуль Journal): при повторном сохранении
+        в тот же файл дописываются только изменения.
+        """
         if self.planButton['text'] == 'Выкл. Планирование':
             tkinter.messagebox.showinfo(
                 'Включен режим планирования',
                 'В режиме "Планирование" нельзя сохранять данные.',
                 parent=self.parent)
             return
+        if not self.calc:
+            tkinter.messagebox.showinfo(
+                'Нет платежей', 'История платежей пуста.', parent=self.parent)
+            return False
         filename = tkinter.filedialog.asksaveasfilename(
             title='Mortgage Calc - Save File',
             initialdir='.',
@@ -292,14 +383,15 @@ class MainWindow:
         if not self.filename.endswith(".clc"):
             self.filename += ".clc"
         try:
-            with open(self.filename, "wb") as fh:
-                pickle.dump(self.__payer_names, fh, pickle.HIGHEST_PROTOCOL)
-                pickle.dump(self.calc, fh, pickle.HIGHEST_PROTOCOL)
+            if self.journal is None or self.journal.filename != self.filename:
+                self.journal = Journal(self.filename)
+            self.journal.save(self.__payer_names, self.calc)
             self.dirty = False
+            self.autosave.discard()
             self.parent.title(
                 "Ипотечный калькулятор - {0}".format(
                     os.path.basename(self.filename)))
-        except (EnvironmentError, pickle.PickleError) as err:
+        except EnvironmentError as err:
             tkinter.messagebox.showwarning(
                 "Mortgage Calculation - Error",
                 "Failed to save {0}:\n{1}".format(self.filename, err),
@@ -310,6 +402,11 @@ class MainWindow:
     def fileQuit(self, event=None):
         """Выход из калькулятора"""
         if self.okayToContinue():
+            if self._loading is not None:
+                self.parent.after_cancel(self._loading)
+            # история сохранена или изменения не нужны
+            self.autosave.discard()
+            self.autosave.stop()
             self.parent.destroy()
 
 
@@ -345,10 +442,20 @@ class MainWindow:
                 self.button[pos]['state'] = 'disabled'
                 self.parent.unbind(shortcut)
                 self.editMenu.entryconfigure(pos + 1, state='disabled')
+        # импорт выписки вносит платежи, как и Add: доступен вместе с ним
+        # (пункт меню после разделителя, кнопки нет)
+        if add is not None:
+            if add:
+                self.parent.bind("<Control-i>", self.paymentImport)
+                self.editMenu.entryconfigure(6, state='normal')
+            else:
+                self.parent.unbind("<Control-i>")
+                self.editMenu.entryconfigure(6, state='disabled')
 
 
     def payersAdd(self):
         """Добавляет имена плательщиков"""
+        from MyForms import PayerNames
         form = PayerNames(self.parent, int(self.count_payersEntry.get()),
                           self.ld.get_loan_data().loan)
         if form.names:
@@ -372,42 +479,49 @@ class MainWindow:
             calc = self._new_instance_of_Calc()
         else:
             calc = self.calc['together']
+        from MyForms import AddEditForm
         form = AddEditForm(self.parent, self.__payer_names, calculation=calc)
         if form.result:
-            if not self.calc:
-                self.dateSpinBox.configure(state='readonly')
-                self.table.set_names(self.__payer_names)
-
-                self.calc['together'] = self._new_instance_of_Calc()
-                loan_data = self.ld.get_loan_data()
-                date = self.dateSpinBox.get_date()
-                for i, name in enumerate(self.__payer_names):
-                    self.calc[name] = Calculation(date, self.__loans[i],
-                                                  loan_data.percent,
-                                                  loan_data.period)
-
-                self.optionsOffOn(delete=True, edit=True, plan=True)
+            self._add_payments(form.result)
 
-            # заполняет новыми платежами основной носитель информации
-            self._fill_calc(form.result)  # form.result: {date: Storage(), ...}
 
-            # сообщает планировщику об изменениях
-            self.advRepWidget.set_changes(self.calc['together'])
-
-            # записывает строки в таблицу
-            self.table.new_payments(self.calc, planning_mode=self.planning_mode)
-
-            # сообщаем дисплею о новом платеже
-            self.display.new_payments(*(
-                (self.calc['together'], None) if not self.planning_mode else \
-                (self._slice_calc(
-                    date_plus_months(self.last_date, 1,
-                                     initdate=self.calc['together'].first_date)
-                    )['together'],
-                 self.calc['together'])
-                ))
-
-            self.dirty = True
+    def paymentImport(self, *ign):
+        """Вносит платежи из банковской выписки (CSV) одним пакетом."""
+        if self.__payer_names is None:
+            if self.count_payersEntry.get() == '':
+                self.count_payersEntry.insert(0, 2)
+            self.payersAdd()
+        if not self.__payer_names:
+            return
+        filename = tkinter.filedialog.askopenfilename(
+            title="Mortgage Calcaulation - Import Statement",
+            filetypes=[("CSV files", "*.csv"), ("All files", "*")],
+            parent=self.parent)
+        if not filename:
+            return
+        from Statement import check_statement, read_statement
+        calc = self.calc['together'] if self.calc else \
+               self._new_instance_of_Calc()
+        try:
+            with open(filename, newline='', encoding='utf-8-sig') as fh:
+                payments, errors = check_statement(
+                    calc, read_statement(fh, self.__payer_names))
+        except (EnvironmentError, UnicodeError) as err:
+            tkinter.messagebox.showwarning(
+                "Mortgage Calcaulation - Error",
+                "Failed to load {0}:\n{1}".format(filename, err),
+                parent=self.parent)
+            return
+        if errors:
+            tkinter.messagebox.showinfo(
+                'Выписка не загружена',
+                'Ошибок: {0}\n\n{1}'.format(
+                    len(errors), '\n'.join(errors[:20] + (
+                        ['...'] if len(errors) > 20 else []))),
+                parent=self.parent)
+            return
+        if payments:
+            self._add_payments(payments)
 
 
     def paymentEdit(self, *ign):
@@ -428,6 +542,7 @@ class MainWindow:
                 parent=self.parent)
             if not reply:
                 return
+        from MyForms import AddEditForm
         changed_payments = {} # хранит измененные платежи
         for date in edit_dates:
             reduct_form = AddEditForm(self.parent, self.__payer_names,
@@ -443,32 +558,26 @@ class MainWindow:
 
         if not changed_payments:
             return
-        # записываем в словарь все платежи,
-        # которые были после самой ранней редактируемой даты (её тоже включаем)
-        reducted_payments = {}
-        for date, info in sorted(self.calc['together'].data.items(),
-                                 reverse=True):
-            if date < min(changed_payments): # меньше самой ранней редактируемой
-                break
-            if reduct_form.debt_is_end:
-                if date > last_payment_date:
-                    break
-            reducted_payments[date] = info
-
-        # меняем старые платежи на измененные
-        reducted_payments.update(changed_payments)
-
-        # удаляем все данные, начиная с самой первой отредактируемой даты,
-        # из основного носителя и подчищаем таблицу
-        self._remove_payments(min(changed_payments))
-
-        # заполняем новыми данными, так как будто это новые платежи
-        self._fill_calc(reducted_payments)
+        # кредит закрыт раньше - платежи после закрытия больше не нужны
+        removed = None
+        if reduct_form.debt_is_end and \
+           last_payment_date < self.calc['together'].date:
+            removed = date_plus_months(
+                last_payment_date, 1,
+                initdate=self.calc['together'].first_date)
+            for calc in self.calc.values():
+                calc.remove_payment(removed)
+
+        # пересчитываем историю от самой ранней отредактированной даты
+        last = self._edit_calc(changed_payments)
         # сообщает планировщику о изменениях
         self.advRepWidget.set_changes(self.calc['together'])
 
-        # записывает строки в таблицу
-        self.table.new_payments(self.calc, planning_mode=self.planning_mode)
+        # обновляем в таблице только пересчитанные строки (галки остаются)
+        self.table.update_rows(self.calc,
+                               modified=(min(changed_payments), last),
+                               removed=removed,
+                               planning_mode=self.planning_mode)
 
         # сообщаем дисплею о изменениях
         self.display.new_payments(*(
@@ -478,12 +587,7 @@ class MainWindow:
                                  initdate=self.calc['together'].first_date)
                 )['together'], self.calc['together'])
             ))
-
-        # развернём все строки, которые были с галками
-        for date in edit_dates:
-            self.table.expend_rowVars[date].set(1)
-            self.table.expand_row(date)
-        self.dirty = True
+        self._changed()
 
         self._is_loan_end_fill_calc()
 
@@ -533,22 +637,87 @@ class MainWindow:
             self.table.view_extra_row(self.calc, view=flag)
 
 
+    def _add_payments(self, new_payments):
+        """Вносит проверенные платежи {date: Storage(), ...} в историю."""
+        if not self.calc:
+            self.dateSpinBox.configure(state='readonly')
+            self.kopecksCheck.configure(state='disabled')
+            self.table.set_names(self.__payer_names)
+
+            self.calc['together'] = self._new_instance_of_Calc()
+            loan_data = self.ld.get_loan_data()
+            date = self.dateSpinBox.get_date()
+            for i, name in enumerate(self.__payer_names):
+                self.calc[name] = Calculation(date, self.__loans[i],
+                                              loan_data.percent,
+                                              loan_data.period,
+                                              kopecks=self.kopecksVar.get())
+
+            self.optionsOffOn(delete=True, edit=True, plan=True)
+
+        # заполняет новыми платежами основной носитель информации
+        self._fill_calc(new_payments)
+
+        # сообщает планировщику об изменениях
+        self.advRepWidget.set_changes(self.calc['together'])
+
+        # записывает строки в таблицу
+        self.table.new_payments(self.calc, planning_mode=self.planning_mode)
+
+        # сообщаем дисплею о новом платеже
+        self.display.new_payments(*(
+            (self.calc['together'], None) if not self.planning_mode else \
+            (self._slice_calc(
+                date_plus_months(self.last_date, 1,
+                                 initdate=self.calc['together'].first_date)
+                )['together'],
+             self.calc['together'])
+            ))
+
+        self._changed()
+
+
     def _fill_calc(self, new_payments):
         """Заполняет новыми платежами основной носитель информации."""
-        self.calc['together'].new_payment(new_payments)
+        # общий расчёт и расчёты плательщиков - за один проход по датам
+        self.calc['together'].new_payment(
+            new_payments,
+            payers=[self.calc[name] for name in self.__payer_names])
+        self._is_loan_end_fill_calc()
+
+
+    def _changed(self):
+        """Отмечает несохранённые изменения (и сообщает автосохранению).
+
+        Запланированные платежи (режим планирования) не сохраняются.
+        """
+        self.dirty = True
+        if self.calc and not self.planning_mode:
+            self.autosave.changed(self.__payer_names, self.calc)
+
+
+    def _edit_calc(self, changed_payments):
+        """Заменяет отредактированные платежи в основном носителе информации.
+
+        Возвращает дату последнего пересчитанного платежа (во всех
+        расчётах): дальше история от правки не изменилась.
+        """
+        last = self.calc['together'].edit_payment(changed_payments)
         for i, name in enumerate(self.__payer_names):
             new_d = {}
-            for date, info in new_payments.items():
+            for date, info in changed_payments.items():
                 new_d[date] = Storage(payment=tuple([info.payment[i]]), \
                                       recalc=info.recalc)
-            self.calc[name].new_payment(new_d)
-        self._is_loan_end_fill_calc()
+            last = max(last, self.calc[name].edit_payment(new_d))
+        return last
 
 
     def _is_loan_end_fill_calc(self):
         """Проверяет выплачен ли полностью кредит."""
-        # 1 вместо 0 из-за погрешности при расчетах
-        if self.calc['together'].loan_sum <= 1:
+        together = self.calc['together']
+        # в копейках долг считается точно, иначе 1 вместо 0 из-за
+        # погрешности при расчетах
+        if together.loan_sum <= (0 if together.kopecks else 1):
             self.optionsOffOn(add=False)
             if not self.planning_mode:
                 self.optionsOffOn(plan=False)
@@ -562,16 +731,47 @@ class MainWindow:
                 if not self.planning_mode:
                     self.optionsOffOn(plan=True)
 
+    def _load_rows(self):
+        """Выводит следующую часть строк загруженной истории.
+
+        Строки таблицы добавляются по LOAD_ROWS за шаг из цикла событий
+        Tk, поэтому окно отвечает во время загрузки; в заголовке окна -
+        сколько уже загружено. После последней строки выводятся диаграмма
+        и планировщик и включаются опции работы с платежами.
+        """
+        self._loading = None
+        remaining = self.table.new_payments(self.calc, limit=self.LOAD_ROWS)
+        title = "Ипотечный калькулятор" if self.filename is None else \
+                "Ипотечный калькулятор - {0}".format(
+                    os.path.basename(self.filename))
+        if remaining:
+            total = len(self.calc['together'].data)
+            self.parent.title("{0} (загрузка {1}%)".format(
+                title, 100 * (total - remaining) // total))
+            self._loading = self.parent.after(1, self._load_rows)
+            return
+        self.parent.title(title)
+        if len(self.__payer_names) > 1:
+            self.menubar.entryconfigure(3, state='normal')
+        self.advRepWidget.set_changes(self.calc['together'])
+        self.display.new_payments(self.calc['together'])
+        self.optionsOffOn(add=True, delete=True, edit=True, plan=True)
+
+
     def _new_instance_of_Calc(self):
         """Возвращает новый экземпляр класса Calculation"""
         loan_data = self.ld.get_loan_data()
         calc = Calculation(self.dateSpinBox.get_date(), loan_data.loan, \
-                           loan_data.percent, loan_data.period)
+                           loan_data.percent, loan_data.period,
+                           kopecks=self.kopecksVar.get())
         return calc
 
 
-    def _remove_payments(self, date):
-        """Удаляет платежи начиная с полученной даты (включительно)."""
+    def _remove_payments(self, date, changed=True):
+        """Удаляет платежи начиная с полученной даты (включительно).
+
+        changed - отмечать ли удаление как изменение истории (см. _changed).
+        """
         self.table.remove_row(date)
 
         for calc in self.calc.values():
@@ -587,17 +787,15 @@ class MainWindow:
                 )['together'], self.calc['together'])
             ))
         self._is_loan_end_fill_calc()
-        self.dirty = True
+        if changed:
+            self._changed()
 
 
     def _slice_calc(self, date):
         """Возвращает срез словаря упорядоченного по ключам
            (от первого элемента до date).
         """
-        new_calc = copy.deepcopy(self.calc)
-        for calc_ in new_calc.values():
-            calc_.remove_payment(date)
-        return new_calc
+        return {name: calc_.snapshot(date) for name, calc_ in self.calc.items()}
 
 
 def main():
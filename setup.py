@@ -9,8 +9,11 @@ setup(name="mortgage_calc",
       author="Alexey Burov",
       author_email="burov_alexey@mail.ru",
       description='Mortgage Calculator',
-      py_modules=['Calculation', 'MyDateLib', 'MyForms', 'MyWidgets'],
+      py_modules=['Autosave', 'Batch', 'Calculation', 'Columnar', 'Engine',
+                  'Journal', 'MyDateLib', 'MyForms', 'MyWidgets', 'Statement',
+                  'Workspace'],
       packages=[],
       requires = ['python (>= 3.1)'],
-      scripts=['mortgage_calc.pyw']
+      scripts=['mortgage_calc.pyw', 'Batch.py', 'Columnar.py',
+               'Workspace.py']
       )